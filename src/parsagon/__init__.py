@@ -1 +1,15 @@
-from parsagon.main import create, update, detail, run, batch_runs, delete, get_product, get_review_article, get_article_list
+from parsagon.main import (
+    create,
+    update,
+    detail,
+    run,
+    batch_runs,
+    remote_batch_runs,
+    delete,
+    get_product,
+    get_review_article,
+    get_article_list,
+    get_products,
+    get_review_articles,
+    get_article_lists,
+)
@@ -1,12 +1,36 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import gzip
+import json
 from json import JSONDecodeError
+import logging
+import random
+import threading
+import time
 
 import httpx
 
 from parsagon import settings
 from parsagon.exceptions import APIException, ProgramNotFoundException
+from parsagon.node_ids import to_json_compatible
+from parsagon.response_cache import get_response_cache
+
+logger = logging.getLogger(__name__)
 
 environment = "PANDAS_1.x"
 
+_client = None
+_client_lock = threading.Lock()
+
+# Threads that send duplicate requests for hedged API calls
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="parsagon-hedge")
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_upload_stats = {"requests": 0, "compressed_requests": 0, "raw_bytes": 0, "sent_bytes": 0}
+_upload_stats_lock = threading.Lock()
+
 
 class RaiseProgramNotFound:
     def __init__(self, program_name):
@@ -27,7 +51,9 @@ def _request_to_exception(response):
     if status_code == 500:
         raise APIException("A server error occurred. Please notify Parsagon.", status_code)
     if status_code in (502, 503, 504):
-        raise APIException("Lost connection to server.", status_code)
+        raise APIException("Lost connection to server.", status_code, _get_retry_after(response))
+    if status_code == 429:
+        raise APIException("Too many requests.", status_code, _get_retry_after(response))
     try:
         errors = response.json()
         if "non_field_errors" in errors:
@@ -38,11 +64,86 @@ def _request_to_exception(response):
         raise APIException("Could not parse response.", status_code)
 
 
-def _api_call(httpx_func, endpoint, **kwargs):
-    api_key = settings.get_api_key()
-    api_endpoint = f"{settings.get_api_base()}/api{endpoint}"
-    headers = {"Authorization": f"Token {api_key}"}
-    r = httpx_func(api_endpoint, headers=headers, timeout=None, **kwargs)
+def _create_client(client_class):
+    """
+    Creates an httpx client (sync or async) configured to talk to the backend.
+    """
+    kwargs = {
+        "base_url": f"{settings.get_api_base()}/api",
+        "headers": {"Authorization": f"Token {settings.get_api_key()}"},
+        "timeout": settings.get_api_timeout(),
+        "limits": httpx.Limits(max_connections=settings.get_api_max_connections()),
+    }
+    try:
+        return client_class(http2=settings.get_api_http2(), **kwargs)
+    except ImportError:
+        logger.debug("HTTP/2 support is not installed - falling back to HTTP/1.1")
+        return client_class(**kwargs)
+
+
+def get_client():
+    """
+    Returns the HTTP client shared by all API calls, creating it on first use.  The client keeps connections to the
+    backend alive between calls and is safe to use from multiple threads.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = _create_client(httpx.Client)
+        return _client
+
+
+def close_client():
+    """
+    Closes the shared HTTP client so that the next API call creates a new one, e.g. after the API key changes.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_upload_stats():
+    """
+    Returns counts of requests and body bytes (before and after compression) sent to HTML-heavy endpoints.
+    """
+    with _upload_stats_lock:
+        return dict(_upload_stats)
+
+
+def _compress(body, encoding):
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            logger.debug("zstandard is not installed - compressing with gzip instead")
+        else:
+            return zstandard.ZstdCompressor().compress(body), "zstd"
+    return gzip.compress(body), "gzip"
+
+
+def _encode_json_body(payload):
+    """
+    Serializes a JSON request body, compressing it if compression is enabled and the body is large enough.
+    :return: Keyword arguments for the httpx request.
+    """
+    body = json.dumps(payload).encode()
+    content = body
+    headers = {"Content-Type": "application/json"}
+    encoding = settings.get_api_compression()
+    if encoding and len(body) >= settings.get_api_compression_min_size():
+        content, encoding = _compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    with _upload_stats_lock:
+        _upload_stats["requests"] += 1
+        _upload_stats["compressed_requests"] += 1 if "Content-Encoding" in headers else 0
+        _upload_stats["raw_bytes"] += len(body)
+        _upload_stats["sent_bytes"] += len(content)
+    return {"content": content, "headers": headers}
+
+
+def _handle_response(r):
     if not r.is_success:
         _request_to_exception(r)
     else:
@@ -52,13 +153,158 @@ def _api_call(httpx_func, endpoint, **kwargs):
             return None
 
 
+def _is_retryable(idempotent, response=None, error=None):
+    """
+    Returns whether a request that got the given response or error can safely be retried.  Requests that are not
+    idempotent are only retried if the server cannot have processed them.
+    """
+    if error is not None:
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True
+        return idempotent and isinstance(error, (httpx.ReadTimeout, httpx.ReadError, httpx.RemoteProtocolError))
+    # Rate limited (429) and unavailable (503) responses are sent without processing the request
+    if response.status_code in (429, 503):
+        return True
+    return idempotent and response.status_code in (502, 504)
+
+
+def _get_retry_after(response):
+    """
+    Returns the number of seconds a response's Retry-After header asks to wait before retrying, or None if it has none.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_retry_delay(attempt, response=None):
+    retry_after = _get_retry_after(response) if response is not None else None
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(settings.get_api_max_retry_delay(), 0.5 * 2**attempt))
+
+
+def _pick_hedged_future(finished_futures, other_futures):
+    """
+    Returns the future of a hedged request whose result should be used: a finished one without an exception if there
+    is one, otherwise one of the others once it finishes.
+    """
+    for future in finished_futures:
+        if future.exception() is None:
+            return future
+    return None if other_futures else next(iter(finished_futures))
+
+
+def _hedged_request(method, endpoint, **kwargs):
+    """
+    Sends a request and, if no response arrives within the hedge delay, a duplicate of it, returning whichever
+    response arrives first.  Only for read-only requests.
+    """
+    client = get_client()
+    futures = {_hedge_pool.submit(client.request, method, endpoint, **kwargs)}
+    finished_futures, futures = wait(futures, timeout=settings.get_api_hedge_delay())
+    if finished_futures:
+        return next(iter(finished_futures)).result()
+    logger.debug("Sending hedged request to %s", endpoint)
+    futures.add(_hedge_pool.submit(client.request, method, endpoint, **kwargs))
+    while True:
+        finished_futures, futures = wait(futures, return_when=FIRST_COMPLETED)
+        future = _pick_hedged_future(finished_futures, futures)
+        if future is not None:
+            return future.result()
+
+
+def _send(method, endpoint, idempotent=None, hedge=False, **kwargs):
+    """
+    Sends a request to the backend, retrying transient failures with capped exponential backoff until the retry
+    deadline.
+    :param idempotent: Whether the request can be repeated without side effects.  Defaults to whether the HTTP method
+    is idempotent.
+    :param hedge: Whether a duplicate request may be sent if the first one is slow.  Only for read-only requests.
+    """
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    if hedge and settings.get_api_hedge_delay() is not None:
+        request = _hedged_request
+    else:
+        request = get_client().request
+    deadline = time.monotonic() + settings.get_api_retry_deadline()
+    attempt = 0
+    while True:
+        try:
+            r = request(method, endpoint, **kwargs)
+            error = None
+        except httpx.TransportError as e:
+            r = None
+            error = e
+        if error is None and not _is_retryable(idempotent, response=r):
+            return r
+        if error is not None and not _is_retryable(idempotent, error=error):
+            raise error
+        delay = _get_retry_delay(attempt, r)
+        if attempt >= settings.get_api_max_retries() or time.monotonic() + delay > deadline:
+            if error is not None:
+                raise error
+            return r
+        logger.debug("Retrying %s %s in %.1fs after %s", method, endpoint, delay, error or r.status_code)
+        time.sleep(delay)
+        attempt += 1
+
+
+def _api_call(method, endpoint, compress=False, cache=False, idempotent=None, hedge=False, **kwargs):
+    """
+    :param compress: Whether the JSON body may be compressed.
+    :param cache: Whether the response may be served from and stored in the local response cache.  Only for calls
+    whose response is fully determined by the request.
+    :param idempotent: Whether the call can be retried after failures the server may have processed.  Defaults to
+    whether the HTTP method is idempotent.
+    :param hedge: Whether a duplicate request may be sent if the first one is slow.  Only for read-only calls.
+    """
+    if "json" in kwargs:
+        # Node ID ranges are only expanded once the request is sent
+        kwargs["json"] = to_json_compatible(kwargs["json"])
+    response_cache = get_response_cache() if cache else None
+    if response_cache is not None:
+        cache_key = response_cache.make_key(method, endpoint, kwargs.get("json"))
+        hit, response = response_cache.get(cache_key)
+        if hit:
+            return response
+    if compress:
+        kwargs.update(_encode_json_body(kwargs.pop("json")))
+    r = _send(method, endpoint, idempotent=idempotent, hedge=hedge, **kwargs)
+    response = _handle_response(r)
+    if response_cache is not None:
+        response_cache.set(cache_key, response)
+    return response
+
+
+def _conditional_api_call(method, endpoint, etag, **kwargs):
+    """
+    Makes an API call, sending the ETag of a previous response so the server can skip sending an unchanged body.
+    :return: A tuple (response, etag) where response is None if it has not changed since the given ETag.
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    r = _send(method, endpoint, headers=headers, **kwargs)
+    if r.status_code == 304:
+        return None, etag
+    return _handle_response(r), r.headers.get("ETag")
+
+
 def get_program_sketches(description):
     """
     Gets a program sketches (full and abridged) from a description.
     :param description: Description in natural language that will be used to generate the scraping program.
     :return: A dict with keys "full", "abridged", and "pseudocode" for the respective program ASTs and pseudocode.
     """
-    return _api_call(httpx.post, "/transformers/get-program-sketch/", json={"description": description})
+    return _api_call("POST", "/transformers/get-program-sketch/", json={"description": description}, idempotent=True)
 
 
 def get_interaction_element_id(marked_html, elem_type, description):
@@ -71,9 +317,11 @@ def get_interaction_element_id(marked_html, elem_type, description):
     """
     assert elem_type.isupper()
     result = _api_call(
-        httpx.post,
+        "POST",
         "/transformers/get-nav-elem/",
         json={"html": marked_html, "elem_type": elem_type, "description": description},
+        compress=True,
+        idempotent=True,
     )["id"]
     return result
 
@@ -84,7 +332,7 @@ def get_schema_fields(schema):
     :param schema:
     :return: A dict mapping fields to their types
     """
-    return _api_call(httpx.post, "/transformers/get-schema-fields/", json={"schema": schema})
+    return _api_call("POST", "/transformers/get-schema-fields/", json={"schema": schema}, cache=True, idempotent=True)
 
 
 def get_cleaned_data(html, schema, nodes):
@@ -96,7 +344,12 @@ def get_cleaned_data(html, schema, nodes):
     :return: Cleaned data
     """
     return _api_call(
-        httpx.post, "/transformers/get-cleaned-data/", json={"html": html, "schema": schema, "nodes": nodes}
+        "POST",
+        "/transformers/get-cleaned-data/",
+        json={"html": html, "schema": schema, "nodes": nodes},
+        compress=True,
+        cache=True,
+        idempotent=True,
     )
 
 
@@ -109,9 +362,12 @@ def scrape_page(html, schema, relevant_elem_ids):
     :return: Scraped data
     """
     return _api_call(
-        httpx.post,
+        "POST",
         "/transformers/get-custom-data/",
         json={"html": html, "schema": schema, "relevant_elem_ids": relevant_elem_ids},
+        compress=True,
+        cache=True,
+        idempotent=True,
     )
 
 
@@ -121,7 +377,9 @@ def get_str_about_data(data, question):
     :param data: the data to give GPT
     :param question: the question to ask about the data
     """
-    data = _api_call(httpx.post, "/transformers/get-str-about-data/", json={"data": data, "question": question})
+    data = _api_call(
+        "POST", "/transformers/get-str-about-data/", json={"data": data, "question": question}, idempotent=True
+    )
     return data["result"]
 
 
@@ -131,33 +389,36 @@ def get_bool_about_data(data, question):
     :param data: the data to give GPT
     :param question: the question to ask about the data
     """
-    data = _api_call(httpx.post, "/transformers/get-bool-about-data/", json={"data": data, "question": question})
+    data = _api_call(
+        "POST", "/transformers/get-bool-about-data/", json={"data": data, "question": question}, idempotent=True
+    )
     return data["result"]
 
 
 def create_pipeline(name, description, program_sketch, pseudocode):
     return _api_call(
-        httpx.post,
+        "POST",
         "/pipelines/",
         json={"name": name, "description": description, "program_sketch": program_sketch, "pseudocode": pseudocode},
     )
 
 
 def delete_pipeline(pipeline_id):
-    return _api_call(httpx.delete, f"/pipelines/{pipeline_id}/")
+    return _api_call("DELETE", f"/pipelines/{pipeline_id}/")
 
 
 def create_custom_function(pipeline_id, call_id, custom_function):
     _api_call(
-        httpx.post,
+        "POST",
         "/transformers/custom-function/",
         json={"pipeline": pipeline_id, "call_id": call_id, **custom_function.to_json()},
+        compress=True,
     )
 
 
 def add_examples_to_custom_function(pipeline_id, call_id, custom_function, remove_old_examples):
     _api_call(
-        httpx.post,
+        "POST",
         "/transformers/custom-function/add-examples/",
         json={
             "pipeline": pipeline_id,
@@ -165,50 +426,99 @@ def add_examples_to_custom_function(pipeline_id, call_id, custom_function, remov
             "remove_old_examples": remove_old_examples,
             **custom_function.to_json(),
         },
+        compress=True,
     )
 
 
 def get_pipeline(pipeline_name):
     with RaiseProgramNotFound(pipeline_name):
         return _api_call(
-            httpx.get,
+            "GET",
             f"/pipelines/name/{pipeline_name}/",
+            hedge=True,
         )
 
 
+def get_pipeline_if_changed(pipeline_name, etag):
+    """
+    Like get_pipeline, but returns None if the pipeline has not changed since the response with the given ETag.
+    :return: A tuple (pipeline, etag)
+    """
+    with RaiseProgramNotFound(pipeline_name):
+        return _conditional_api_call("GET", f"/pipelines/name/{pipeline_name}/", etag, hedge=True)
+
+
 def get_pipelines():
-    return _api_call(httpx.get, f"/pipelines/")
+    return _api_call("GET", f"/pipelines/")
 
 
 def get_pipeline_code(pipeline_name, variables, headless):
     with RaiseProgramNotFound(pipeline_name):
         return _api_call(
-            httpx.post,
+            "POST",
+            f"/pipelines/name/{pipeline_name}/code/",
+            json={
+                "variables": variables,
+                "headless": headless,
+            },
+            idempotent=True,
+        )
+
+
+def get_pipeline_code_if_changed(pipeline_name, variables, headless, etag):
+    """
+    Like get_pipeline_code, but returns None code if the code has not changed since the response with the given ETag.
+    :return: A tuple (code, etag)
+    """
+    with RaiseProgramNotFound(pipeline_name):
+        return _conditional_api_call(
+            "POST",
             f"/pipelines/name/{pipeline_name}/code/",
+            etag,
             json={
                 "variables": variables,
                 "headless": headless,
             },
+            idempotent=True,
         )
 
 
 def create_pipeline_run(pipeline_id, variables):
     return _api_call(
-        httpx.post,
+        "POST",
         f"/pipelines/{pipeline_id}/runs/",
         json={"variables": variables},
     )
 
 
-def get_run(run_id):
+def _long_poll_params(wait):
+    return {"params": {"wait": wait}} if wait else {}
+
+
+def get_run(run_id, wait=None):
     """
     Gets details about a run
+    :param wait: If supported by the server, the maximum number of seconds to hold the request open until the run
+    finishes (long polling).
     """
     return _api_call(
-        httpx.get,
+        "GET",
         f"/pipelines/runs/{run_id}/",
+        hedge=not wait,
+        **_long_poll_params(wait),
     )
 
 
-def poll_data(url, page_type):
-    return _api_call(httpx.post, "/extract/", json={"url": url, "page_type": page_type})
+def poll_data(url, page_type, wait=None):
+    """
+    :param wait: If supported by the server, the maximum number of seconds to hold the request open until the data is
+    ready (long polling).
+    """
+    return _api_call(
+        "POST",
+        "/extract/",
+        json={"url": url, "page_type": page_type},
+        idempotent=True,
+        hedge=not wait,
+        **_long_poll_params(wait),
+    )
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import httpx
+
+from parsagon import settings
+from parsagon.api import (
+    IDEMPOTENT_METHODS,
+    RaiseProgramNotFound,
+    _create_client,
+    _encode_json_body,
+    _get_retry_delay,
+    _handle_response,
+    _is_retryable,
+    _long_poll_params,
+    _pick_hedged_future,
+)
+from parsagon.node_ids import to_json_compatible
+from parsagon.response_cache import get_response_cache
+
+logger = logging.getLogger(__name__)
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Returns the async HTTP client shared by all API calls made from the running event loop, creating it on first use.
+    Like parsagon.api.get_client, but lets many API calls be issued concurrently from one event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _create_client(httpx.AsyncClient)
+        _clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    """
+    Closes the async HTTP client of the running event loop.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def _hedged_request(method, endpoint, **kwargs):
+    client = get_async_client()
+    tasks = {asyncio.ensure_future(client.request(method, endpoint, **kwargs))}
+    finished_tasks, tasks = await asyncio.wait(tasks, timeout=settings.get_api_hedge_delay())
+    if finished_tasks:
+        return next(iter(finished_tasks)).result()
+    logger.debug("Sending hedged request to %s", endpoint)
+    tasks.add(asyncio.ensure_future(client.request(method, endpoint, **kwargs)))
+    try:
+        while True:
+            finished_tasks, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            task = _pick_hedged_future(finished_tasks, tasks)
+            if task is not None:
+                return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _send(method, endpoint, idempotent=None, hedge=False, **kwargs):
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    if hedge and settings.get_api_hedge_delay() is not None:
+        request = _hedged_request
+    else:
+        request = get_async_client().request
+    deadline = time.monotonic() + settings.get_api_retry_deadline()
+    attempt = 0
+    while True:
+        try:
+            r = await request(method, endpoint, **kwargs)
+            error = None
+        except httpx.TransportError as e:
+            r = None
+            error = e
+        if error is None and not _is_retryable(idempotent, response=r):
+            return r
+        if error is not None and not _is_retryable(idempotent, error=error):
+            raise error
+        delay = _get_retry_delay(attempt, r)
+        if attempt >= settings.get_api_max_retries() or time.monotonic() + delay > deadline:
+            if error is not None:
+                raise error
+            return r
+        logger.debug("Retrying %s %s in %.1fs after %s", method, endpoint, delay, error or r.status_code)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _api_call(method, endpoint, compress=False, cache=False, idempotent=None, hedge=False, **kwargs):
+    if "json" in kwargs:
+        kwargs["json"] = to_json_compatible(kwargs["json"])
+    response_cache = get_response_cache() if cache else None
+    if response_cache is not None:
+        cache_key = response_cache.make_key(method, endpoint, kwargs.get("json"))
+        hit, response = response_cache.get(cache_key)
+        if hit:
+            return response
+    if compress:
+        kwargs.update(_encode_json_body(kwargs.pop("json")))
+    r = await _send(method, endpoint, idempotent=idempotent, hedge=hedge, **kwargs)
+    response = _handle_response(r)
+    if response_cache is not None:
+        response_cache.set(cache_key, response)
+    return response
+
+
+async def get_program_sketches(description):
+    """
+    Gets a program sketches (full and abridged) from a description.
+    :param description: Description in natural language that will be used to generate the scraping program.
+    :return: A dict with keys "full", "abridged", and "pseudocode" for the respective program ASTs and pseudocode.
+    """
+    return await _api_call(
+        "POST", "/transformers/get-program-sketch/", json={"description": description}, idempotent=True
+    )
+
+
+async def get_interaction_element_id(marked_html, elem_type, description):
+    """
+    Gets the ID of the element matching a description.
+    :param marked_html: HTML with data-psgn-id attributes.
+    :param elem_type: One of INPUT, BUTTON, or SELECT.
+    :param description: A natural language description of the element.
+    :return: The integer ID (data-psgn-id) of the element in the marked HTML.
+    """
+    assert elem_type.isupper()
+    result = await _api_call(
+        "POST",
+        "/transformers/get-nav-elem/",
+        json={"html": marked_html, "elem_type": elem_type, "description": description},
+        compress=True,
+        idempotent=True,
+    )
+    return result["id"]
+
+
+async def get_schema_fields(schema):
+    """
+    Gets fields and their types from a given schema
+    :param schema:
+    :return: A dict mapping fields to their types
+    """
+    return await _api_call(
+        "POST", "/transformers/get-schema-fields/", json={"schema": schema}, cache=True, idempotent=True
+    )
+
+
+async def get_cleaned_data(html, schema, nodes):
+    """
+    Gets cleaned data from the nodes to be scraped.
+    :param html: HTML of the page to scrape
+    :param schema: Schema of the data to scrape
+    :param nodes: Nodes to scrape
+    :return: Cleaned data
+    """
+    return await _api_call(
+        "POST",
+        "/transformers/get-cleaned-data/",
+        json={"html": html, "schema": schema, "nodes": nodes},
+        compress=True,
+        cache=True,
+        idempotent=True,
+    )
+
+
+async def scrape_page(html, schema, relevant_elem_ids):
+    """
+    Scrapes data from the provided page HTML - data will be returned in the schema provided.
+    :param html: HTML of the page to scrape.
+    :param schema: Schema of the data to scrape
+    :param relevant_elem_ids: Ids of elements to be considered
+    :return: Scraped data
+    """
+    return await _api_call(
+        "POST",
+        "/transformers/get-custom-data/",
+        json={"html": html, "schema": schema, "relevant_elem_ids": relevant_elem_ids},
+        compress=True,
+        cache=True,
+        idempotent=True,
+    )
+
+
+async def get_str_about_data(data, question):
+    """
+    Asks GPT a question about the given data.
+    :param data: the data to give GPT
+    :param question: the question to ask about the data
+    """
+    data = await _api_call(
+        "POST", "/transformers/get-str-about-data/", json={"data": data, "question": question}, idempotent=True
+    )
+    return data["result"]
+
+
+async def get_bool_about_data(data, question):
+    """
+    Asks GPT a question about the given data.
+    :param data: the data to give GPT
+    :param question: the question to ask about the data
+    """
+    data = await _api_call(
+        "POST", "/transformers/get-bool-about-data/", json={"data": data, "question": question}, idempotent=True
+    )
+    return data["result"]
+
+
+async def create_pipeline(name, description, program_sketch, pseudocode):
+    return await _api_call(
+        "POST",
+        "/pipelines/",
+        json={"name": name, "description": description, "program_sketch": program_sketch, "pseudocode": pseudocode},
+    )
+
+
+async def delete_pipeline(pipeline_id):
+    return await _api_call("DELETE", f"/pipelines/{pipeline_id}/")
+
+
+async def create_custom_function(pipeline_id, call_id, custom_function):
+    await _api_call(
+        "POST",
+        "/transformers/custom-function/",
+        json={"pipeline": pipeline_id, "call_id": call_id, **custom_function.to_json()},
+        compress=True,
+    )
+
+
+async def add_examples_to_custom_function(pipeline_id, call_id, custom_function, remove_old_examples):
+    await _api_call(
+        "POST",
+        "/transformers/custom-function/add-examples/",
+        json={
+            "pipeline": pipeline_id,
+            "call_id": call_id,
+            "remove_old_examples": remove_old_examples,
+            **custom_function.to_json(),
+        },
+        compress=True,
+    )
+
+
+async def get_pipeline(pipeline_name):
+    with RaiseProgramNotFound(pipeline_name):
+        return await _api_call("GET", f"/pipelines/name/{pipeline_name}/", hedge=True)
+
+
+async def get_pipelines():
+    return await _api_call("GET", f"/pipelines/")
+
+
+async def get_pipeline_code(pipeline_name, variables, headless):
+    with RaiseProgramNotFound(pipeline_name):
+        return await _api_call(
+            "POST",
+            f"/pipelines/name/{pipeline_name}/code/",
+            json={
+                "variables": variables,
+                "headless": headless,
+            },
+            idempotent=True,
+        )
+
+
+async def create_pipeline_run(pipeline_id, variables):
+    return await _api_call(
+        "POST",
+        f"/pipelines/{pipeline_id}/runs/",
+        json={"variables": variables},
+    )
+
+
+async def get_run(run_id, wait=None):
+    """
+    Gets details about a run
+    :param wait: If supported by the server, the maximum number of seconds to hold the request open until the run
+    finishes (long polling).
+    """
+    return await _api_call("GET", f"/pipelines/runs/{run_id}/", hedge=not wait, **_long_poll_params(wait))
+
+
+async def poll_data(url, page_type, wait=None):
+    """
+    :param wait: If supported by the server, the maximum number of seconds to hold the request open until the data is
+    ready (long polling).
+    """
+    return await _api_call(
+        "POST",
+        "/extract/",
+        json={"url": url, "page_type": page_type},
+        idempotent=True,
+        hedge=not wait,
+        **_long_poll_params(wait),
+    )
@@ -0,0 +1,376 @@
+import csv
+import heapq
+import json
+import logging
+from pathlib import Path
+import random
+import time
+
+import httpx
+
+from parsagon.exceptions import APIException, ProgramNotFoundException
+
+logger = logging.getLogger(__name__)
+
+
+class BatchCheckpoint:
+    """
+    Saves the results of a batch as they finish.  Results are appended to {batch_name}.jsonl, one JSON object per line
+    tagged with the index of its run, and the indices of finished runs are appended to {batch_name}.index so that a
+    resumed batch can skip them without loading any results.
+    """
+
+    def __init__(self, batch_name):
+        self.results_path = Path(f"{batch_name}.jsonl")
+        self.index_path = Path(f"{batch_name}.index")
+        self.legacy_path = Path(f"{batch_name}.json")
+        self.submitted_path = Path(f"{batch_name}.submitted")
+        # Runs usually finish close to input order, so finished runs are tracked as the number of runs up to which all
+        # runs are finished plus a small set of finished runs after that to keep memory bounded
+        self.num_done_prefix = 0
+        self.done_after_prefix = set()
+        self._results_file = None
+        self._index_file = None
+        self._submitted_file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        if not self.results_path.exists() and self.legacy_path.exists():
+            self._import_legacy()
+        for path in (self.results_path, self.index_path, self.submitted_path):
+            self._truncate_partial_line(path)
+        if self.index_path.exists():
+            with self.index_path.open() as f:
+                for line in f:
+                    self._mark_done(int(line))
+        elif self.results_path.exists():
+            # The index is missing, so rebuild it from the results
+            with self.index_path.open("w") as f:
+                for index, _ in self.iter_results():
+                    self._mark_done(index)
+                    f.write(f"{index}\n")
+        self._results_file = self.results_path.open("a")
+        self._index_file = self.index_path.open("a")
+
+    @staticmethod
+    def _truncate_partial_line(path):
+        """
+        Removes a partially written last line left by a killed process.
+        """
+        if not path.exists():
+            return
+        with path.open("rb+") as f:
+            content_size = f.seek(0, 2)
+            if content_size == 0:
+                return
+            f.seek(-1, 2)
+            if f.read(1) == b"\n":
+                return
+            # Search backwards for the end of the last complete line
+            position = content_size
+            while position > 0:
+                chunk_size = min(4096, position)
+                position -= chunk_size
+                f.seek(position)
+                chunk = f.read(chunk_size)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    f.truncate(position + newline + 1)
+                    return
+            f.truncate(0)
+
+    def _import_legacy(self):
+        """
+        Converts a batch saved in the old format (a JSON list of results of the first runs) to a checkpoint.
+        """
+        logger.info(f"Importing saved results from {self.legacy_path}")
+        with self.legacy_path.open() as f:
+            results = json.load(f)
+        with self.results_path.open("w") as f:
+            for index, result in enumerate(results):
+                f.write(json.dumps({"index": index, "result": result}) + "\n")
+        with self.index_path.open("w") as f:
+            f.writelines(f"{index}\n" for index in range(len(results)))
+
+    def add(self, index, result):
+        """
+        Saves the result of a run.  The result is flushed before the run is marked as done, so a killed process at
+        worst reruns a run whose result was already saved.
+        """
+        self._results_file.write(json.dumps({"index": index, "result": result}) + "\n")
+        self._results_file.flush()
+        self._index_file.write(f"{index}\n")
+        self._index_file.flush()
+        self._mark_done(index)
+
+    def _mark_done(self, index):
+        if index < self.num_done_prefix:
+            return
+        self.done_after_prefix.add(index)
+        while self.num_done_prefix in self.done_after_prefix:
+            self.done_after_prefix.remove(self.num_done_prefix)
+            self.num_done_prefix += 1
+
+    def is_done(self, index):
+        return index < self.num_done_prefix or index in self.done_after_prefix
+
+    @property
+    def num_done(self):
+        return self.num_done_prefix + len(self.done_after_prefix)
+
+    def add_submitted(self, index, run_id):
+        """
+        Saves the ID of a remote run that was started for a run of the batch, so that a resumed batch can wait for it
+        instead of starting it again.
+        """
+        if self._submitted_file is None:
+            self._submitted_file = self.submitted_path.open("a")
+        self._submitted_file.write(json.dumps({"index": index, "run_id": run_id}) + "\n")
+        self._submitted_file.flush()
+
+    def get_submitted(self):
+        """
+        Returns a dict mapping the IDs of started remote runs that do not have results yet to the indices of their runs.
+        """
+        if not self.submitted_path.exists():
+            return {}
+        submitted = {}
+        with self.submitted_path.open() as f:
+            for line in f:
+                entry = json.loads(line)
+                if not self.is_done(entry["index"]):
+                    submitted[entry["run_id"]] = entry["index"]
+        return submitted
+
+    def iter_results(self):
+        """
+        Yields (index, result) tuples in the order the results were saved.
+        """
+        with self.results_path.open() as f:
+            for line in f:
+                entry = json.loads(line)
+                yield entry["index"], entry["result"]
+
+    def get_results(self, num_runs):
+        """
+        Returns the results of the first num_runs runs in run order.
+        """
+        results = {}
+        for index, result in self.iter_results():
+            if index < num_runs:
+                results[index] = result
+        return [results[index] for index in range(num_runs)]
+
+    def close(self):
+        for f in (self._results_file, self._index_file, self._submitted_file):
+            if f is not None:
+                f.close()
+        self._results_file = None
+        self._index_file = None
+        self._submitted_file = None
+
+
+def read_jsonl_runs(path):
+    """
+    Lazily reads the variables of each run from a file with one JSON object per line.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv_runs(path):
+    """
+    Lazily reads the variables of each run from a CSV file, mapping column headers to variable names.
+    """
+    with open(path, newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def iter_runs(runs):
+    """
+    Returns the variables of each run from an iterable of dicts (such as a list) or the path to a .jsonl or .csv file.
+    """
+    if isinstance(runs, (str, Path)):
+        suffix = Path(runs).suffix.lower()
+        if suffix == ".jsonl":
+            return read_jsonl_runs(runs)
+        elif suffix == ".csv":
+            return read_csv_runs(runs)
+        raise ValueError(f"Runs must be read from a .jsonl or .csv file, not {runs}")
+    return runs
+
+
+# Maximum number of times to retry a run for each kind of error
+DEFAULT_MAX_RETRIES = {
+    "server": 5,
+    "browser": 3,
+    "assertion": 1,
+    "fatal": 0,
+    "unknown": 2,
+}
+
+
+class RetryPolicy:
+    """
+    Decides whether and when to retry a failed run based on the kind of error, backing off exponentially with jitter.
+    """
+
+    def __init__(self, max_retries=None, base_delay=5, max_delay=300):
+        """
+        :param max_retries: A dict overriding entries of DEFAULT_MAX_RETRIES.
+        :param base_delay: Seconds to wait before the first retry.
+        :param max_delay: Maximum number of seconds to wait before a retry.
+        """
+        self.max_retries = {**DEFAULT_MAX_RETRIES, **(max_retries or {})}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def classify(error):
+        """
+        Returns the kind of error, one of the keys of DEFAULT_MAX_RETRIES.
+        """
+        from selenium.common.exceptions import WebDriverException
+
+        if isinstance(error, ProgramNotFoundException):
+            return "fatal"
+        if isinstance(error, APIException):
+            if error.status_code in (429, 502, 503, 504):
+                return "server"
+            return "fatal" if 400 <= error.status_code < 500 else "unknown"
+        if isinstance(error, httpx.TransportError):
+            return "server"
+        if isinstance(error, WebDriverException):
+            return "browser"
+        if isinstance(error, AssertionError):
+            return "assertion"
+        return "unknown"
+
+    @staticmethod
+    def was_rejected(error):
+        """
+        Returns whether a request that failed with the error cannot have been processed by the server, so that retrying
+        it cannot repeat its side effects (such as starting a remote run twice).
+        """
+        if isinstance(error, APIException):
+            return error.status_code in (429, 503)
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+    def get_retry_delay(self, error, attempt):
+        """
+        :param attempt: The number of the attempt that failed, starting at 0.
+        :return: The number of seconds to wait before retrying, or None if the run should not be retried.
+        """
+        if attempt >= self.max_retries[self.classify(error)]:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        # Wait at least as long as a rate limited or overloaded server asked to
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Pauses a batch when several runs in a row fail because the backend is unreachable, waiting longer each time the
+    backend is still down after a pause.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=60, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.consecutive_failures = 0
+        self.num_trips = 0
+        self.open_until = 0
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.num_trips = 0
+
+    def record_failure(self, error_class):
+        if error_class != "server":
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            pause = min(self.max_cooldown, self.cooldown * 2**self.num_trips)
+            logger.warning(f"The Parsagon backend appears to be down - pausing the batch for {pause}s")
+            self.open_until = time.monotonic() + pause
+            self.consecutive_failures = 0
+            self.num_trips += 1
+
+    def get_wait_time(self):
+        return max(0, self.open_until - time.monotonic())
+
+
+class RunScheduler:
+    """
+    Hands out runs in input order, interleaving failed runs once their backoff has elapsed so that other runs keep
+    going in the meantime.
+    """
+
+    def __init__(self, pending_runs, retry_policy=None, circuit_breaker=None):
+        """
+        :param pending_runs: An iterable of (index, variables) tuples.
+        """
+        self.pending_runs = iter(pending_runs)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.retries = []
+        self.exhausted = False
+
+    def is_finished(self):
+        return self.exhausted and not self.retries
+
+    def get_wait_time(self):
+        """
+        Returns the number of seconds until a retry becomes ready or the circuit breaker closes.
+        """
+        retry_wait_time = max(0, self.retries[0][0] - time.monotonic()) if self.retries else 0
+        return max(retry_wait_time, self.circuit_breaker.get_wait_time())
+
+    def next_run(self, block=True):
+        """
+        Returns the next (index, variables, attempt) to run.  Returns None if every run has been handed out, or if
+        block is False and no run is ready yet.
+        """
+        while True:
+            breaker_wait_time = self.circuit_breaker.get_wait_time()
+            if breaker_wait_time > 0:
+                if not block:
+                    return None
+                time.sleep(breaker_wait_time)
+            if self.retries and self.retries[0][0] <= time.monotonic():
+                _, i, attempt, variables = heapq.heappop(self.retries)
+                return i, variables, attempt
+            if not self.exhausted:
+                for i, variables in self.pending_runs:
+                    return i, variables, 0
+                self.exhausted = True
+            if not self.retries or not block:
+                return None
+            time.sleep(self.get_wait_time())
+
+    def record_success(self):
+        self.circuit_breaker.record_success()
+
+    def record_failure(self, i, variables, attempt, error):
+        """
+        Requeues a failed run if it should be retried.
+        :return: The number of seconds until the retry, or None if the run will not be retried.
+        """
+        self.circuit_breaker.record_failure(self.retry_policy.classify(error))
+        delay = self.retry_policy.get_retry_delay(error, attempt)
+        if delay is not None:
+            heapq.heappush(self.retries, (time.monotonic() + delay, i, attempt + 1, variables))
+        return delay
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import threading
+
+import psutil
+from pyvirtualdisplay import Display
+import undetected_chromedriver as uc
+from selenium.common.exceptions import WebDriverException
+from webdriver_manager.chrome import ChromeDriverManager
+
+from parsagon import settings
+
+logger = logging.getLogger(__name__)
+
+_driver_path_lock = threading.Lock()
+
+
+def get_driver_path(refresh=False):
+    """
+    Returns the path to chromedriver.  The path resolved by webdriver_manager is saved in the cache directory and reused
+    while the file exists, so later processes skip the version check and download.
+    :param refresh: Whether to resolve the path again, e.g. because Chrome was updated.
+    """
+    path_file = settings.get_cache_dir() / "chromedriver.json"
+    with _driver_path_lock:
+        if not refresh:
+            try:
+                with path_file.open() as f:
+                    driver_path = json.load(f)["path"]
+                if os.path.exists(driver_path):
+                    return driver_path
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        driver_path = ChromeDriverManager().install()
+        path_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump({"path": driver_path}, f)
+        os.replace(tmp_path, path_file)
+        return driver_path
+
+
+def _get_chrome_options():
+    chrome_options = uc.ChromeOptions()
+    chrome_options.add_argument("--start-maximized")
+    return chrome_options
+
+
+class BrowserSession:
+    """
+    A running browser and, in headless mode, the virtual display it renders to.
+    """
+
+    def __init__(self, headless=False):
+        self.headless = headless
+        self.display = Display(visible=False, size=(1280, 1050)).start() if headless else None
+        try:
+            self.driver = self._start_driver()
+        except Exception:
+            if self.display is not None:
+                self.display.stop()
+            raise
+
+    @staticmethod
+    def _start_driver():
+        try:
+            return uc.Chrome(driver_executable_path=get_driver_path(), options=_get_chrome_options())
+        except WebDriverException as e:
+            # The saved driver may not match a Chrome that has since been updated
+            logger.debug(f"Could not start Chrome with the saved driver ({e}) - resolving the driver again")
+            return uc.Chrome(driver_executable_path=get_driver_path(refresh=True), options=_get_chrome_options())
+
+    def quit(self):
+        service_process = getattr(getattr(self.driver, "service", None), "process", None)
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass
+        # undetected_chromedriver sometimes leaves its driver running, so kill it without touching other browsers
+        if service_process is not None:
+            try:
+                psutil.Process(service_process.pid).kill()
+            except psutil.NoSuchProcess:
+                pass
+        if self.display is not None:
+            self.display.stop()
@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import multiprocessing
+import socketserver
+import threading
+
+from parsagon.exceptions import ParsagonException
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker():
+    """
+    Loads the browser automation libraries and the API client once per worker process instead of once per run.
+    """
+    import parsagon.executor
+    from parsagon.api import get_client
+
+    get_client()
+
+
+def _warm_up():
+    pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RunServer:
+    """
+    Runs programs on request in long-lived worker processes, which keep their imports, API session and compiled
+    pipelines between runs.  Up to concurrency runs execute at once and up to max_queue more wait for a worker.
+    """
+
+    def __init__(self, run, concurrency=2, max_queue=100, headless=False):
+        """
+        :param run: The function that runs a program, called as run(program_name, variables, headless, remote).
+        """
+        self.run = run
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.headless = headless
+        self.num_unfinished = 0
+        self.num_finished = 0
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._pool = ProcessPoolExecutor(
+            max_workers=concurrency, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+        )
+        # Start the workers now so that the first runs do not wait for them
+        for future in [self._pool.submit(_warm_up) for _ in range(concurrency)]:
+            future.result()
+
+    def stats(self):
+        with self._lock:
+            # Workers take runs in the order they were submitted, so every unfinished run beyond the number of workers
+            # is waiting for one
+            num_running = min(self.num_unfinished, self.concurrency)
+            return {
+                "running": num_running,
+                "queued": self.num_unfinished - num_running,
+                "finished": self.num_finished,
+            }
+
+    def submit(self, program_name, variables, headless=None, remote=False):
+        """
+        Queues a run.
+        :return: A future for the output of the run, or None if the queue is full.
+        """
+        with self._lock:
+            if self.num_unfinished >= self.concurrency + self.max_queue:
+                return None
+            self.num_unfinished += 1
+        if headless is None:
+            # Remote runs cannot be headless
+            headless = self.headless and not remote
+        future = self._pool.submit(self.run, program_name, variables, headless, remote)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._finish)
+        return future
+
+    def _finish(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            self.num_unfinished -= 1
+            self.num_finished += 1
+
+    def make_http_server(self, host="127.0.0.1", port=8765, socket_path=None):
+        """
+        Returns a server accepting runs over HTTP, on a Unix socket if socket_path is given and on host and port
+        otherwise.  POST /run with a JSON body {"program_name": ..., "variables": {...}, "headless": ..., "remote": ...}
+        responds with {"output": ...} once the run finishes, and GET /status responds with the number of runs.  Runs
+        must be sent with a Content-Type of application/json, which browsers only allow web pages to send to another
+        origin after a CORS preflight that this server does not answer.
+        """
+        handler = self._make_handler()
+        if socket_path is not None:
+            return ThreadingUnixHTTPServer(str(socket_path), handler)
+        return ThreadingHTTPServer((host, port), handler)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                # The client address of a Unix socket is empty, so it is left out
+                logger.debug(format, *args)
+
+            def _respond(self, status, body, headers=None):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                if self.path == "/status":
+                    self._respond(200, server.stats())
+                else:
+                    self._respond(404, {"error": "Not found"})
+
+            def do_POST(self):
+                if self.path != "/run":
+                    self._respond(404, {"error": "Not found"})
+                    return
+                # Web pages can send simple requests (e.g. text/plain) to local servers without a CORS preflight
+                if self.headers.get_content_type() != "application/json":
+                    self._respond(415, {"error": "Expected Content-Type: application/json"})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    program_name = request["program_name"]
+                    variables = request.get("variables", {})
+                except (ValueError, KeyError, TypeError):
+                    self._respond(400, {"error": "Expected a JSON object with a program_name"})
+                    return
+                future = server.submit(program_name, variables, request.get("headless"), request.get("remote", False))
+                if future is None:
+                    self._respond(503, {"error": "Too many queued runs"}, {"Retry-After": "1"})
+                    return
+                try:
+                    output = future.result()
+                except ParsagonException as e:
+                    self._respond(500, {"error": e.to_string(False)})
+                except Exception as e:
+                    self._respond(500, {"error": repr(e)})
+                else:
+                    self._respond(200, {"output": output})
+
+        return Handler
+
+    def close(self):
+        # Executor.shutdown only cancels queued futures itself from Python 3.9 on
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._pool.shutdown()
@@ -6,10 +6,18 @@ class ParsagonException(Exception):
 
 
 class APIException(ParsagonException):
-    def __init__(self, value, status_code):
+    def __init__(self, value, status_code, retry_after=None):
+        """
+        :param retry_after: Number of seconds the server asked to wait before retrying, if it did.
+        """
         super().__init__(value)
         self.value = value
         self.status_code = status_code
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Allows the exception to be sent between processes
+        return self.__class__, (self.value, self.status_code, self.retry_after)
 
     def to_string(self, verbose):
         return f"{self.status_code} - {self.value}"
@@ -3,19 +3,15 @@ import copy
 import json
 import logging
 from pathlib import Path
-import psutil
 import time
 from urllib.parse import urljoin
 
+import lxml.etree
 import lxml.html
-from pyvirtualdisplay import Display
-import undetected_chromedriver as uc
-from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
 from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.select import Select
-from webdriver_manager.chrome import ChromeDriverManager
 
 from parsagon.api import (
     get_interaction_element_id,
@@ -25,8 +21,11 @@ from parsagon.api import (
     get_str_about_data,
     get_bool_about_data,
 )
+from parsagon.browser import BrowserSession
 from parsagon.custom_function import CustomFunction
 from parsagon.exceptions import ParsagonException
+from parsagon.node_ids import ENCODE_NODE_IDS_JS, NodeIdRanges
+from parsagon.waits import PageSettler, ELEM_READY_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +54,169 @@ ELEMENT_TYPES = {
 }
 
 
+# Collects the IDs of all marked elements that are not displayed in a single pass over the DOM.  Descendants of a
+# hidden element are skipped since removing the hidden element removes them as well.
+INVISIBLE_ELEM_IDS_SCRIPT = """
+const elems = document.querySelectorAll('[data-psgn-id]');
+const sized = new Set();
+for (let i = elems.length - 1; i >= 0; i--) {
+    const elem = elems[i];
+    const rect = elem.getBoundingClientRect();
+    if (sized.has(elem) || (rect.width > 0 && rect.height > 0)) {
+        sized.add(elem);
+        if (elem.parentElement) {
+            sized.add(elem.parentElement);
+        }
+    }
+}
+const hidden = new Set();
+const hiddenIds = [];
+for (const elem of elems) {
+    const parent = elem.parentElement;
+    if (parent && hidden.has(parent)) {
+        hidden.add(elem);
+        continue;
+    }
+    const tagName = elem.tagName.toLowerCase();
+    if (['html', 'body', 'option', 'optgroup'].includes(tagName)) {
+        continue;
+    }
+    const style = window.getComputedStyle(elem);
+    if (style.display === 'none' || style.visibility !== 'visible' || style.opacity === '0' || !sized.has(elem)) {
+        hidden.add(elem);
+        hiddenIds.push(elem.getAttribute('data-psgn-id'));
+    }
+}
+return hiddenIds;
+"""
+
+
+# Assigns node IDs (and image dimensions) to every element on the first call in a document, then installs an observer
+# so that later calls only have to mark elements added since.  Marked elements are registered by ID (without keeping
+# removed elements alive) so that they can be looked up without searching the document.  Takes the first free ID and
+# returns the next one.
+MARK_HTML_SCRIPT = """
+if (!window.psgnMarker) {
+    const marker = { nextId: arguments[0], sizedImages: new WeakSet(), elemsById: new Map() };
+    const unregister = new FinalizationRegistry((id) => {
+        if (!marker.elemsById.get(id)?.deref()) {
+            marker.elemsById.delete(id);
+        }
+    });
+    const setImageSize = (image) => {
+        image.setAttribute('data-psgn-width', image.parentElement?.offsetWidth ?? -1);
+        image.setAttribute('data-psgn-height', image.parentElement?.offsetHeight ?? -1);
+    };
+    const markElem = (elem) => {
+        if (!elem.hasAttribute('data-psgn-id')) {
+            const id = String(marker.nextId);
+            elem.setAttribute('data-psgn-id', id);
+            marker.elemsById.set(id, new WeakRef(elem));
+            unregister.register(elem, id);
+            marker.nextId++;
+        }
+        if (elem.tagName === 'IMG' && !marker.sizedImages.has(elem)) {
+            marker.sizedImages.add(elem);
+            setImageSize(elem);
+            elem.addEventListener('load', () => setImageSize(elem));
+        }
+    };
+    marker.processRecords = (records) => {
+        for (const record of records) {
+            for (const node of record.addedNodes) {
+                if (node.nodeType !== Node.ELEMENT_NODE || !node.isConnected) {
+                    continue;
+                }
+                markElem(node);
+                for (const elem of node.querySelectorAll('*')) {
+                    markElem(elem);
+                }
+            }
+        }
+    };
+    marker.observer = new MutationObserver(marker.processRecords);
+    marker.observer.observe(document, { childList: true, subtree: true });
+    for (const elem of document.all) {
+        markElem(elem);
+    }
+    window.psgnMarker = marker;
+}
+window.psgnMarker.processRecords(window.psgnMarker.observer.takeRecords());
+return window.psgnMarker.nextId;
+"""
+
+
+# Returns the element with a node ID from the registry kept by MARK_HTML_SCRIPT, falling back to searching the document
+# if the element is not registered or no longer has that ID
+ELEM_BY_ID_SCRIPT = """
+const id = String(arguments[0]);
+const elem = window.psgnMarker?.elemsById.get(id)?.deref();
+if (elem && elem.isConnected && elem.getAttribute('data-psgn-id') === id) {
+    return elem;
+}
+return document.querySelector(`[data-psgn-id="${CSS.escape(id)}"]`);
+"""
+
+
+# Returns the node IDs (encoded as ranges) of the elements matching a CSS selector, an XPath selector, or (with
+# neither) the stored examples of the highlights script, so that the IDs of any number of elements are collected in one
+# round trip
+SELECTED_NODE_IDS_SCRIPT = (
+    ENCODE_NODE_IDS_JS
+    + """
+const [cssSelector, xpathSelector] = arguments;
+let elems;
+if (cssSelector) {
+    elems = document.querySelectorAll(cssSelector);
+} else if (xpathSelector) {
+    const result = document.evaluate(xpathSelector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    elems = [];
+    for (let i = 0; i < result.snapshotLength; i++) {
+        const node = result.snapshotItem(i);
+        if (node.nodeType === Node.ELEMENT_NODE) {
+            elems.push(node);
+        }
+    }
+} else {
+    elems = document.getElementsByClassName('parsagon-io-example-stored');
+}
+return encodeNodeIds(Array.from(elems, (elem) => elem.getAttribute('data-psgn-id')));
+"""
+)
+
+
+# Returns the node IDs (encoded as ranges) of the stored examples of the highlights script and all of their descendants
+SELECTED_NODE_AND_DESCENDANT_IDS_SCRIPT = (
+    ENCODE_NODE_IDS_JS
+    + """
+const ids = [];
+for (const elem of document.getElementsByClassName('parsagon-io-example-stored')) {
+    ids.push(elem.getAttribute('data-psgn-id'));
+    for (const descendant of elem.querySelectorAll('*')) {
+        ids.push(descendant.getAttribute('data-psgn-id'));
+    }
+}
+return encodeNodeIds(ids);
+"""
+)
+
+
+# Returns a version string for the current document that changes whenever the DOM is mutated
+DOM_VERSION_SCRIPT = """
+if (!window.psgnDomVersion) {
+    const version = { token: Math.random().toString(36).slice(2), count: 0 };
+    new MutationObserver((records) => { version.count += records.length; }).observe(document, {
+        childList: true,
+        subtree: true,
+        attributes: true,
+        characterData: true,
+    });
+    window.psgnDomVersion = version;
+}
+return `${window.psgnDomVersion.token}:${window.psgnDomVersion.count}:${location.href}`;
+"""
+
+
 class Executor:
     """
     Executes code produced by GPT with the proper context.  Records custom_function usage along the way.
@@ -62,13 +224,13 @@ class Executor:
 
     def __init__(self, headless=False, infer=False):
         self.headless = headless
-        if self.headless:
-            self.display = Display(visible=False, size=(1280, 1050)).start()
-        chrome_options = uc.ChromeOptions()
-        chrome_options.add_argument("--start-maximized")
-        driver_exec_path = ChromeDriverManager().install()
-        self.driver = uc.Chrome(driver_executable_path=driver_exec_path, options=chrome_options)
+        self.session = BrowserSession(headless)
+        self.driver = self.session.driver
+        self.settler = PageSettler(self.driver)
         self.max_elem_ids = defaultdict(int)
+        self.cleaned_page_cache = {}
+        # Maps window handles to the identifier of the highlights script registered in them
+        self.highlights_windows = {}
         self.execution_context = {
             "custom_assert": self.custom_assert,
             "goto": self.goto,
@@ -102,44 +264,89 @@ class Executor:
         else:
             self.custom_functions[call_id] = custom_function
 
-    def inject_highlights_script(self):
+    def inject_highlights_script(self, force=False):
+        """
+        Makes sure the highlights script runs in the current window.  The script is registered with Chrome the first
+        time so that it runs in every later document of the window by itself, and is only sent again after actions if
+        registration is not supported.  In infer mode the script is only injected once a selection is needed.
+        :param force: Whether to inject the script even in infer mode.
+        """
+        if self.infer and not force:
+            return
+        window_handle = self.driver.current_window_handle
+        if window_handle in self.highlights_windows:
+            return
         self.driver.execute_script(self.highlights_script)
+        try:
+            # Registered scripts run at the top level of every document, including frames, so they are wrapped to
+            # skip frames and to keep their declarations from shadowing globals of the page such as CSS
+            source = f"(() => {{\nif (window.top !== window) return;\n{self.highlights_script}\n}})();"
+            result = self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": source})
+        except WebDriverException as e:
+            logger.debug(f"Could not register highlights script ({e}) - injecting it after every action instead")
+            return
+        self.highlights_windows[window_handle] = result.get("identifier")
 
     def highlights_setup(self, field_type, max_examples="null"):
+        self.inject_highlights_script(force=True)
         self.driver.execute_script(f"window.currentFieldType = '{field_type}'; window.maxExamples = {max_examples};")
 
     def highlights_cleanup(self):
-        self.driver.execute_script(f"window.currentFieldType = null; window.maxExamples = null; window.clearCSS();")
+        self.driver.execute_script(f"window.currentFieldType = null; window.maxExamples = null; window.clearCSS?.();")
 
-    def get_selected_node_ids(self, css_selector=None, xpath_selector=None):
-        if css_selector:
-            return [elem.get_attribute("data-psgn-id") for elem in self.driver.find_elements(By.CSS_SELECTOR, css_selector)]
-        elif xpath_selector:
-            return [elem.get_attribute("data-psgn-id") for elem in self.driver.find_elements(By.XPATH, xpath_selector)]
-        else:
-            return [elem.get_attribute("data-psgn-id") for elem in self.driver.find_elements(By.CLASS_NAME, "parsagon-io-example-stored")]
+    def get_selected_node_ids(self, css_selector=None, xpath_selector=None, nested=False):
+        """
+        Returns the node IDs of the elements matching a CSS or XPath selector, or of the elements the user selected if
+        neither is given, as NodeIdRanges.
+        :param nested: Whether the IDs are sent as single-ID lists, as in the nodes of scraped fields.
+        """
+        ranges = self.driver.execute_script(SELECTED_NODE_IDS_SCRIPT, css_selector, xpath_selector)
+        return NodeIdRanges(ranges, nested=nested)
 
     def get_selected_node_and_descendant_ids(self):
-        return self.driver.execute_script(
-            "return Array.from(document.getElementsByClassName('parsagon-io-example-stored')).map((elem) => [elem, ...elem.querySelectorAll('*')]).flat().map((elem) => elem.getAttribute('data-psgn-id'))"
-        )
+        return NodeIdRanges(self.driver.execute_script(SELECTED_NODE_AND_DESCENDANT_IDS_SCRIPT))
 
     def mark_html(self):
         """
-        Adds node IDs to elements on the current page that don't already have IDs.
+        Adds node IDs to elements on the current page that don't already have IDs.  After the first call on a page,
+        only elements added since the previous call are visited.
         """
         logger.debug("  Marking HTML...")
-        max_elem_id = self.max_elem_ids[self.driver.current_window_handle]
-        max_elem_id = self.driver.execute_script(
-            f"let elemIdx = {max_elem_id}; "
-            + "for (const node of document.all) { if (node.hasAttribute('data-psgn-id')) { continue; } node.setAttribute('data-psgn-id', elemIdx); elemIdx++; } return elemIdx;"
-        )
-        self.max_elem_ids[self.driver.current_window_handle] = max_elem_id
-        self.driver.execute_script(
-            "for (const image of document.images) { image.setAttribute('data-psgn-width', image.parentElement.offsetWidth ?? -1); image.setAttribute('data-psgn-height', image.parentElement.offsetHeight ?? -1); }"
+        window_handle = self.driver.current_window_handle
+        self.max_elem_ids[window_handle] = self.driver.execute_script(
+            MARK_HTML_SCRIPT, self.max_elem_ids[window_handle]
         )
 
+    def _get_dom_version(self):
+        """
+        Returns a string that changes whenever the DOM of the current document changes, or None if it cannot be read.
+        """
+        try:
+            return self.driver.execute_script(DOM_VERSION_SCRIPT)
+        except WebDriverException:
+            return None
+
+    def _get_cleaned_page(self):
+        """
+        Returns a dict with the cleaned lxml root of the current page and (once computed) its serialized HTML.  The page
+        source is only re-fetched and re-parsed if the DOM has changed since the last call in the current window.
+        """
+        window_handle = self.driver.current_window_handle
+        dom_version = self._get_dom_version()
+        cached_page = self.cleaned_page_cache.get(window_handle)
+        if dom_version is not None and cached_page is not None and cached_page["dom_version"] == dom_version:
+            return cached_page
+        page = {"dom_version": dom_version, "root": self._parse_cleaned_lxml_root(), "html": None}
+        self.cleaned_page_cache[window_handle] = page
+        return page
+
     def _get_cleaned_lxml_root(self):
+        """
+        Returns a copy of the cleaned lxml root of the current page that the caller is free to modify.
+        """
+        return copy.deepcopy(self._get_cleaned_page()["root"])
+
+    def _parse_cleaned_lxml_root(self):
         parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
         root = lxml.html.fromstring(self.driver.page_source.replace("&nbsp;", " "), parser=parser)
 
@@ -168,8 +375,10 @@ class Executor:
         """
         Returns cleaned html from the driver with script, noscript, and style elements removed, designed to preserve scrapable data.
         """
-        root = self._get_cleaned_lxml_root()
-        return lxml.html.tostring(root).decode()
+        page = self._get_cleaned_page()
+        if page["html"] is None:
+            page["html"] = lxml.html.tostring(page["root"]).decode()
+        return page["html"]
 
     def get_visible_html(self):
         """
@@ -178,29 +387,37 @@ class Executor:
         All elements must have node IDs added as data attributes.
         """
 
-        driver = self.driver
-        assert "data-psgn-id" in driver.page_source
         root = self._get_cleaned_lxml_root()
+        elems_by_id = self._index_by_id(root)
+        assert elems_by_id
 
         # Remove head elements
         for elem in root.iterfind(".//head"):
             elem.text = ""
 
         # Remove invisible elements
-        max_elem_id = self.max_elem_ids[self.driver.current_window_handle]
-        for elem_id in range(max_elem_id):
-            try:
-                lxml_elem = root.xpath(f'//*[@data-psgn-id="{elem_id}"]')[0]
-                selenium_elem = driver.find_elements(By.XPATH, f'//*[@data-psgn-id="{elem_id}"]')[0]
-            except IndexError:
+        for elem_id in self.driver.execute_script(INVISIBLE_ELEM_IDS_SCRIPT):
+            lxml_elem = elems_by_id.get(elem_id)
+            if lxml_elem is None:
                 continue
-            if not selenium_elem.is_displayed():
-                parent = lxml_elem.getparent()
-                if parent is not None:
-                    parent.remove(lxml_elem)
+            parent = lxml_elem.getparent()
+            if parent is not None:
+                parent.remove(lxml_elem)
 
         return lxml.html.tostring(root).decode()
 
+    @staticmethod
+    def _index_by_id(root):
+        """
+        Returns a dict mapping node IDs to the elements of an lxml tree in a single pass over the tree.
+        """
+        elems_by_id = {}
+        for elem in root.iter(lxml.etree.Element):
+            elem_id = elem.get("data-psgn-id")
+            if elem_id is not None:
+                elems_by_id.setdefault(elem_id, elem)
+        return elems_by_id
+
     def get_elem(self, description, elem_type):
         if self.infer:
             return self.get_elem_by_description(description, elem_type)
@@ -210,7 +427,12 @@ class Executor:
         )
         self.mark_html()
         selected_node_ids = self.get_selected_node_ids()
-        while user_input != "N/A" and not selected_node_ids and not user_input.startswith("XPATH:") and not user_input.startswith("CSS:"):
+        while (
+            user_input != "N/A"
+            and not selected_node_ids
+            and not user_input.startswith("XPATH:")
+            and not user_input.startswith("CSS:")
+        ):
             user_input = input('Please click an element or type "N/A": ')
             selected_node_ids = self.get_selected_node_ids()
         self.highlights_cleanup()
@@ -248,7 +470,9 @@ class Executor:
         Gets a selenium element by Parsagon ID (psgn-id).
         """
         assert elem_id is not None
-        result = self.driver.find_element(By.XPATH, f'//*[@data-psgn-id="{elem_id}"]')
+        result = self.driver.execute_script(ELEM_BY_ID_SCRIPT, str(elem_id))
+        if result is None:
+            raise NoSuchElementException(f"No element with ID {elem_id}")
         return result
 
     def custom_assert(self, v):
@@ -265,7 +489,7 @@ class Executor:
         self.driver.get(url)
 
         # Wait for website to load
-        time.sleep(2)
+        self.settler.wait("goto")
         self.mark_html()
         self.inject_highlights_script()
 
@@ -274,6 +498,8 @@ class Executor:
     def close_window(self, window_id):
         if self.driver.current_window_handle != window_id:
             self.driver.switch_to.window(window_id)
+        self.cleaned_page_cache.pop(window_id, None)
+        self.highlights_windows.pop(window_id, None)
         self.driver.close()
         self.driver.switch_to.window(self.driver.window_handles[-1])
 
@@ -282,9 +508,10 @@ class Executor:
             self.driver.switch_to.window(window_id)
 
         try:
+            # Clicking through JavaScript works on hidden elements too, so there is no need to wait for the element
             self.driver.execute_script("arguments[0].click();", elem)
             logger.info("Clicked element")
-            time.sleep(2)
+            self.settler.wait("click")
         except Exception as e:
             return False
         self.mark_html()
@@ -323,7 +550,7 @@ class Executor:
         html = self.get_scrape_html()
         prev_html = self.driver.page_source
         success = self._click_elem(elem, window_id) if elem else False
-        time.sleep(1)
+        self.settler.wait("next_page")
         custom_function = CustomFunction(
             "click_next_page",
             arguments={},
@@ -345,13 +572,14 @@ class Executor:
 
         for i in range(3):
             try:
+                self.settler.wait_for_elem(elem, ELEM_READY_TIMEOUT)
                 select_obj = Select(elem)
                 select_obj.select_by_visible_text(option)
                 logger.info(f'Selected option "{option}"')
-                time.sleep(2)
+                self.settler.wait("select")
                 break
             except:
-                time.sleep(2)
+                self.settler.wait("select")
         else:
             return False
         self.mark_html()
@@ -393,16 +621,17 @@ class Executor:
 
         for i in range(3):
             try:
+                self.settler.wait_for_elem(elem, ELEM_READY_TIMEOUT)
                 elem.clear()
                 elem.send_keys(text)
                 logger.info(f'Typed "{text}" into element')
                 if enter:
                     elem.send_keys(Keys.RETURN)
                     logger.debug("Pressed enter")
-                time.sleep(2)
+                self.settler.wait("fill")
                 break
             except:
-                time.sleep(2)
+                self.settler.wait("fill")
         else:
             return False
         self.mark_html()
@@ -446,14 +675,14 @@ class Executor:
         self.driver.execute_script(
             f"window.scrollTo({{top: document.documentElement.scrollHeight * {y}, left: document.documentElement.scrollWidth * {x}, behavior: 'smooth'}});"
         )
-        time.sleep(1)
+        self.settler.wait("scroll")
 
     def press_key(self, key, window_id):
         if self.driver.current_window_handle != window_id:
             self.driver.switch_to.window(window_id)
         logger.info(f"Pressing {key}")
         ActionChains(self.driver).send_keys(getattr(Keys, key)).perform()
-        time.sleep(1)
+        self.settler.wait("press_key")
 
     def join_text(strings):
         return "\\n\\n".join(strings)
@@ -475,7 +704,7 @@ class Executor:
             user_input = "INFER"
         else:
             user_input = input(
-                f'Now determining what elements to scrape to collect data in the format {schema}. Hit ENTER to continue by clicking on the elements to scrape, or type a valid command: '
+                f"Now determining what elements to scrape to collect data in the format {schema}. Hit ENTER to continue by clicking on the elements to scrape, or type a valid command: "
             )
             while user_input not in ("", "INFER"):
                 user_input = input('Hit ENTER or type "INFER": ')
@@ -497,14 +726,14 @@ class Executor:
                 )
                 if field_input.startswith("CSS:"):
                     css_selector = field_input[4:].strip()
-                    nodes[field] = [[node_id] for node_id in self.get_selected_node_ids(css_selector=css_selector)]
+                    nodes[field] = self.get_selected_node_ids(css_selector=css_selector, nested=True)
                     css_selectors[field] = css_selector
                 elif field_input.startswith("XPATH:"):
                     xpath_selector = field_input[6:].strip()
-                    nodes[field] = [[node_id] for node_id in self.get_selected_node_ids(xpath_selector=xpath_selector)]
+                    nodes[field] = self.get_selected_node_ids(xpath_selector=xpath_selector, nested=True)
                     xpath_selectors[field] = xpath_selector
                 else:
-                    nodes[field] = [[node_id] for node_id in self.get_selected_node_ids()]
+                    nodes[field] = self.get_selected_node_ids(nested=True)
                 self.highlights_cleanup()
             logger.info("Scraping data...")
             result = get_cleaned_data(html, schema, nodes)
@@ -551,12 +780,4 @@ class Executor:
         try:
             exec(code, self.execution_context)
         finally:
-            self.driver.quit()
-            for proc in psutil.process_iter():
-                try:
-                    if proc.name() == "chromedriver":
-                        proc.kill()
-                except psutil.NoSuchProcess:
-                    continue
-            if self.headless:
-                self.display.stop()
+            self.session.quit()
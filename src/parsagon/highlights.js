@@ -145,7 +145,74 @@ function isValidSelector(selector) {
     return true
 }
 
+// getSimilar results are cached per list of elements until the structure or the classes of the document change, since
+// adding or removing an example recomputes the selectors of the same ancestors over and over
+const PARSAGON_CLASSNAME_PREFIX = 'parsagon-io-';
+const similarSelectorCache = new Map();
+const MAX_SIMILAR_SELECTOR_CACHE_SIZE = 1000;
+const elementKeys = new WeakMap();
+let nextElementKey = 0;
+let similarSelectorObserver = null;
+
+function getElementKey(element) {
+    let key = elementKeys.get(element);
+    if (key === undefined) {
+        key = nextElementKey++;
+        elementKeys.set(element, key);
+    }
+    return key;
+}
+
+function getPageClasses(classNames) {
+    return new Set(classNames.filter((className) => className && !className.startsWith(PARSAGON_CLASSNAME_PREFIX)));
+}
+
+// Returns whether a mutation can change selectors, ignoring the highlight classes set by this script
+function changesSelectors(mutation) {
+    if (mutation.type !== 'attributes') {
+        return true;
+    }
+    const oldClasses = getPageClasses((mutation.oldValue || '').split(/\s+/));
+    const newClasses = getPageClasses(Array.from(mutation.target.classList));
+    if (oldClasses.size !== newClasses.size) {
+        return true;
+    }
+    for (const className of newClasses) {
+        if (!oldClasses.has(className)) {
+            return true;
+        }
+    }
+    return false;
+}
+
 function getSimilar(elements) {
+    if (similarSelectorObserver === null) {
+        similarSelectorObserver = new MutationObserver((mutations) => {
+            if (mutations.some(changesSelectors)) {
+                similarSelectorCache.clear();
+            }
+        });
+        similarSelectorObserver.observe(document, {
+            childList: true,
+            subtree: true,
+            attributes: true,
+            attributeFilter: ['class'],
+            attributeOldValue: true,
+        });
+    }
+    const key = elements.map(getElementKey).join(',');
+    let selector = similarSelectorCache.get(key);
+    if (selector === undefined) {
+        selector = computeSimilar(elements);
+        if (similarSelectorCache.size >= MAX_SIMILAR_SELECTOR_CACHE_SIZE) {
+            similarSelectorCache.clear();
+        }
+        similarSelectorCache.set(key, selector);
+    }
+    return selector;
+}
+
+function computeSimilar(elements) {
     let tag = '*';
     if (elements.every((elem) => elem.tagName === elements[0].tagName)) {
         tag = elements[0].tagName.toLowerCase();
@@ -360,6 +427,9 @@ function handleClick(e) {
     e.preventDefault();
     e.stopImmediatePropagation();
 
+    // Highlight the element under the mouse before selecting it if the last move has not been handled yet
+    flushMouseMove();
+
     const srcElement = document.querySelector(
         `.${MOUSE_VISITED_CLASSNAME}`
     );
@@ -405,6 +475,10 @@ function handleMouseDown(e) {
     e.stopImmediatePropagation();
 };
 
+// Mouse moves are handled at most once per animation frame, using the position of the last move
+let pendingMouseMove = null;
+let mouseMoveFrame = null;
+
 function handleMouseMove(e) {
     if (window.currentFieldType === null) {
         return;
@@ -413,6 +487,22 @@ function handleMouseMove(e) {
     e.preventDefault();
     e.stopImmediatePropagation();
 
+    pendingMouseMove = { clientX: e.clientX, clientY: e.clientY };
+    if (mouseMoveFrame === null) {
+        mouseMoveFrame = requestAnimationFrame(flushMouseMove);
+    }
+};
+
+function flushMouseMove() {
+    if (mouseMoveFrame !== null) {
+        cancelAnimationFrame(mouseMoveFrame);
+        mouseMoveFrame = null;
+    }
+    const move = pendingMouseMove;
+    pendingMouseMove = null;
+    if (move === null || window.currentFieldType === null) {
+        return;
+    }
     if (
         window.maxExamples &&
         getNumExamples() >= window.maxExamples
@@ -420,14 +510,37 @@ function handleMouseMove(e) {
         return;
     }
 
+    const srcElement = findHoveredElement(move.clientX, move.clientY);
+    // Moves within the highlighted element change nothing
+    if (srcElement !== null && srcElement === window.prevDOM && srcElement.classList.contains(MOUSE_VISITED_CLASSNAME)) {
+        return;
+    }
     if (window.prevDOM != null) {
         removeMouseVisitedCSS(window.prevDOM);
+        window.prevDOM = null;
+    }
+    if (srcElement === null) {
+        return;
     }
 
+    makeVisible(srcElement);
+
+    addMouseVisitedCSS(srcElement);
+    window.prevDOM = srcElement;
+}
+
+function measureCandidate(elem) {
+    return { elem, area: elem.offsetHeight * elem.offsetWidth, rect: elem.getBoundingClientRect() };
+}
+
+// Returns the element to highlight at a point, or null.  Layout is read for all candidates before anything is written
+// so that the page is laid out once rather than once per candidate.
+function findHoveredElement(clientX, clientY) {
+    const filters = DATA_TYPE_FILTERS[window.currentFieldType];
     let candidates =
         document.elementsFromPoint(
-            e.clientX,
-            e.clientY
+            clientX,
+            clientY
         );
     if (['URL', 'IMAGE'].includes(window.currentFieldType)) {
         const newCandidates = new Set();
@@ -444,63 +557,40 @@ function handleMouseMove(e) {
         }
         candidates.push(...newCandidates);
     }
-    candidates = [...candidates].filter((elem) => {
-        if (
-            !elem.matches(
-                DATA_TYPE_FILTERS[window.currentFieldType].includes
-            )
-        ) {
-            return false;
-        }
-        if (elem.offsetHeight * elem.offsetWidth === 0) {
-            if (elem.tagName === 'A') {
-                elem.style.display = 'inline-block';
-            } else {
-                return false;
-            }
-        }
+    candidates = [...new Set(candidates)].filter(
+        (elem) => elem.matches(filters.includes) && !(filters.excludes && elem.matches(filters.excludes))
+    );
 
-        const rect = elem.getBoundingClientRect();
-        if (
-            e.clientX < rect.left ||
-            e.clientX > rect.right ||
-            e.clientY < rect.top ||
-            e.clientY > rect.bottom
-        ) {
-            return false;
+    let measured = candidates.map(measureCandidate);
+    // Links without a size are given one so that they can be selected, then measured again after a single layout
+    const hiddenLinks = measured.filter(({ elem, area }) => area === 0 && elem.tagName === 'A');
+    if (hiddenLinks.length) {
+        for (const { elem } of hiddenLinks) {
+            elem.style.display = 'inline-block';
         }
-
-        return true;
-    });
-    if (DATA_TYPE_FILTERS[window.currentFieldType].excludes) {
-        candidates = candidates.filter(
-            (elem) =>
-                !elem.matches(
-                    DATA_TYPE_FILTERS[window.currentFieldType].excludes
-                )
-        );
+        measured = measured.map((candidate) => candidate.area === 0 ? measureCandidate(candidate.elem) : candidate);
     }
-    if (!candidates.length) {
-        return;
+    measured = measured.filter(({ elem, area, rect }) => (
+        (area !== 0 || elem.tagName === 'A') &&
+        clientX >= rect.left &&
+        clientX <= rect.right &&
+        clientY >= rect.top &&
+        clientY <= rect.bottom
+    ));
+    if (!measured.length) {
+        return null;
     }
-    candidates.sort(
-        (a, b) =>
-            a.offsetHeight * a.offsetWidth - b.offsetHeight * b.offsetWidth
-    );
+    measured.sort((a, b) => a.area - b.area);
 
     const srcElement = getRepresentative(
-        candidates[0],
+        measured[0].elem,
         window.currentFieldType
     );
     if (!hasValidData(srcElement, window.currentFieldType)) {
-        return;
+        return null;
     }
-
-    makeVisible(srcElement);
-
-    addMouseVisitedCSS(srcElement);
-    window.prevDOM = srcElement;
-};
+    return srcElement;
+}
 
 function handleSelectionShift() {
     if (window.currentFieldType === null) {
@@ -552,11 +642,19 @@ function handleKeyUp(e) {
 
 if (!window.PSGN_INITIALIZED) {
     window.PSGN_INITIALIZED = true;
-    const style = document.createElement('style');
-    document.head.appendChild(style);
-    style.type = 'text/css';
-    const text = document.createTextNode(CSS);
-    style.appendChild(text);
+    const addStyle = () => {
+        const style = document.createElement('style');
+        document.head.appendChild(style);
+        style.type = 'text/css';
+        const text = document.createTextNode(CSS);
+        style.appendChild(text);
+    };
+    // When registered to run in new documents, the script runs before the head exists
+    if (document.head) {
+        addStyle();
+    } else {
+        document.addEventListener('DOMContentLoaded', addStyle);
+    }
 
     window.addEventListener(
         'mousemove',
@@ -1,12 +1,14 @@
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
 import json
 import logging
 import logging.config
-import psutil
+import multiprocessing
+from pathlib import Path
 import time
 
-from halo import Halo
-from tqdm import tqdm
+import httpx
 
 from parsagon.api import (
     get_program_sketches,
@@ -17,15 +19,27 @@ from parsagon.api import (
     create_pipeline_run,
     get_pipeline,
     get_pipelines,
-    get_pipeline_code,
     get_run,
     poll_data,
+    close_client,
     APIException,
 )
+from parsagon.batch import BatchCheckpoint, RetryPolicy, RunScheduler, iter_runs
+from parsagon.daemon import RunServer
 from parsagon.exceptions import ParsagonException
-from parsagon.executor import Executor, custom_functions_to_descriptions
-from parsagon.settings import get_api_key, get_settings, clear_settings, save_setting, get_logging_config
+from parsagon.pipeline_cache import get_pipeline_cache
+from parsagon.polling import AdaptivePoller
+from parsagon.settings import (
+    get_api_key,
+    get_api_long_poll_wait,
+    get_settings,
+    clear_settings,
+    save_setting,
+    get_logging_config,
+)
 
+# Browser automation, progress display and async libraries are imported by the functions that use them, so that
+# commands which only talk to the API start quickly
 logger = logging.getLogger(__name__)
 
 
@@ -163,6 +177,49 @@ def get_args():
     )
     parser_setup.set_defaults(func=setup)
 
+    # Serve
+    parser_serve = subparsers.add_parser(
+        "serve",
+        description="Runs programs on request from a long-running local server.",
+    )
+    parser_serve.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="the host to listen on",
+    )
+    parser_serve.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="the port to listen on",
+    )
+    parser_serve.add_argument(
+        "--socket",
+        dest="socket_path",
+        type=str,
+        help="listen on this Unix socket instead of a port",
+    )
+    parser_serve.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="the number of programs to run at once",
+    )
+    parser_serve.add_argument(
+        "--max-queue",
+        dest="max_queue",
+        type=int,
+        default=100,
+        help="the number of runs that may wait for a free worker before new runs are rejected",
+    )
+    parser_serve.add_argument(
+        "--headless",
+        action="store_true",
+        help="run browsers in headless mode unless a run specifies otherwise",
+    )
+    parser_serve.set_defaults(func=serve)
+
     args = parser.parse_args()
     kwargs = vars(args)
     return kwargs, parser
@@ -185,6 +242,8 @@ def main():
 
 
 def create(task=None, program_name=None, headless=False, infer=False, verbose=False):
+    from parsagon.executor import Executor, custom_functions_to_descriptions
+
     if task:
         logger.info("Launched with task description:\n%s", task)
     else:
@@ -196,7 +255,9 @@ def create(task=None, program_name=None, headless=False, infer=False, verbose=Fa
     full_program = program_sketches["full"]
     abridged_program = program_sketches["abridged"]
     pseudocode = program_sketches["pseudocode"]
-    logger.info(f"Created a program based on task description. Program does the following:\n\n{pseudocode}\n\nNow executing the program to identify web elements to be scraped:\n")
+    logger.info(
+        f"Created a program based on task description. Program does the following:\n\n{pseudocode}\n\nNow executing the program to identify web elements to be scraped:\n"
+    )
     logger.debug("Program:\n%s", abridged_program)
     abridged_program += "\n\noutput = func()\nprint(f'Program finished and returned a value of:\\n{output}\\n')\n"  # Make the program runnable
 
@@ -243,6 +304,8 @@ def create(task=None, program_name=None, headless=False, infer=False, verbose=Fa
 
 
 def update(program_name, variables={}, headless=False, infer=False, replace=False, verbose=False):
+    from parsagon.executor import Executor, custom_functions_to_descriptions
+
     pipeline = get_pipeline(program_name)
     abridged_program = pipeline["abridged_sketch"]
     # Make the program runnable
@@ -255,7 +318,9 @@ def update(program_name, variables={}, headless=False, infer=False, replace=Fals
     executor.execute(abridged_program)
 
     while True:
-        program_name_input = input(f"Type \"{program_name}\" to update this program, or press enter without typing a name to CANCEL: ")
+        program_name_input = input(
+            f'Type "{program_name}" to update this program, or press enter without typing a name to CANCEL: '
+        )
         if not program_name_input:
             logger.info("Canceled update.")
             return
@@ -296,35 +361,45 @@ def run(program_name, variables={}, headless=False, remote=False, verbose=False)
     if headless and remote:
         raise ParsagonException("Cannot run a program remotely in headless mode")
 
+    pipeline_cache = get_pipeline_cache()
     if remote:
-        pipeline_id = get_pipeline(program_name)["id"]
+        from halo import Halo
+
+        pipeline_id = pipeline_cache.get_pipeline(program_name)["id"]
         result = create_pipeline_run(pipeline_id, variables)
+
+        def check_run():
+            run = get_run(result["id"], wait=get_api_long_poll_wait())
+            return run["status"] in ("FINISHED", "ERROR", "CANCELED"), run
+
         with Halo(text="Program running remotely...", spinner="dots"):
-            while True:
-                run = get_run(result["id"])
-                status = run["status"]
-                if status == "FINISHED":
-                    logger.info("Program finished running.")
-                    return run["output"]
-                elif status == "ERROR":
-                    raise ParsagonException(f"Program failed to run: {run['error']}")
-                elif status == "CANCELED":
-                    raise ParsagonException("Program execution was canceled")
-                time.sleep(5)
+            # Never poll less often than the fixed 5 second interval this replaced
+            run = AdaptivePoller(initial_interval=1, max_interval=5).poll(check_run)
+        status = run["status"]
+        if status == "FINISHED":
+            logger.info("Program finished running.")
+            return run["output"]
+        elif status == "ERROR":
+            raise ParsagonException(f"Program failed to run: {run['error']}")
+        else:
+            raise ParsagonException("Program execution was canceled")
 
     logger.info("Preparing to run program %s", program_name)
-    code = get_pipeline_code(program_name, variables, headless)["code"]
+    code = pipeline_cache.get_pipeline_code(program_name, variables, headless)["code"]
 
     logger.info("Running program...")
+    import psutil
+
     globals_locals = {"PARSAGON_API_KEY": get_api_key()}
     try:
-        exec(code, globals_locals, globals_locals)
+        exec(pipeline_cache.compile(program_name, code), globals_locals, globals_locals)
     finally:
         if "driver" in globals_locals:
             globals_locals["driver"].quit()
         if "display" in globals_locals:
             globals_locals["display"].stop()
-        for proc in psutil.process_iter():
+        # Only kill drivers started by this process so that runs in other worker processes are unaffected
+        for proc in psutil.Process().children(recursive=True):
             try:
                 if proc.name() == "chromedriver":
                     proc.kill()
@@ -334,51 +409,285 @@ def run(program_name, variables={}, headless=False, remote=False, verbose=False)
     return globals_locals["output"]
 
 
-def batch_runs(batch_name, program_name, runs=[], headless=False, ignore_errors=False, error_value=None):
-    save_file = f"{batch_name}.json"
-    try:
-        with open(save_file) as f:
-            results = json.load(f)
-    except FileNotFoundError:
-        results = []
-    num_initial_results = len(results)
-    pbar = tqdm(runs)
+def batch_runs(
+    batch_name,
+    program_name,
+    runs=[],
+    headless=False,
+    ignore_errors=False,
+    error_value=None,
+    concurrency=1,
+    return_results=True,
+    retry_policy=None,
+):
+    """
+    Runs a program once for each set of variables in runs.  Each result is appended to {batch_name}.jsonl as soon as
+    its run finishes, and rerunning the same batch skips runs that already have results.
+    :param runs: A list or other (possibly lazy) iterable of variable dicts, or the path to a .jsonl or .csv file with
+    one set of variables per line or row.  Runs are read as they are needed.
+    :param concurrency: Number of runs to execute at once, each in its own process with its own browser.  Worker
+    processes are started with spawn, which re-imports the __main__ module, so scripts calling batch_runs with a
+    concurrency above 1 must do so under an if __name__ == "__main__": guard.
+    :param return_results: If False, return an empty list instead of loading all results into memory once the batch
+    finishes.  Results can still be read from the checkpoint with BatchCheckpoint.iter_results.
+    :param retry_policy: A RetryPolicy deciding how often and after how long failed runs are retried.  Failed runs wait
+    for their retry while other runs continue.
+    """
+    from tqdm import tqdm
+
+    runs = iter_runs(runs)
+    # Runs read from a file are counted as they are read
+    total = len(runs) if hasattr(runs, "__len__") else None
+    num_runs = 0
     default_desc = f'Running program "{program_name}"'
-    pbar.set_description(default_desc)
     error = None
     error_variables = None
+    with BatchCheckpoint(batch_name) as checkpoint:
+
+        def iter_pending_runs():
+            nonlocal num_runs
+            for i, variables in enumerate(runs):
+                num_runs = i + 1
+                if not checkpoint.is_done(i):
+                    yield i, variables
+
+        scheduler = RunScheduler(iter_pending_runs(), retry_policy)
+        pbar = tqdm(total=total, initial=checkpoint.num_done)
+        pbar.set_description(default_desc)
+
+        def finish_run(i, variables, attempt, result=None, exception=None):
+            nonlocal error, error_variables
+            if exception is None:
+                scheduler.record_success()
+                pbar.set_description(default_desc)
+            else:
+                delay = scheduler.record_failure(i, variables, attempt, exception)
+                if delay is not None:
+                    pbar.set_description(
+                        f"An error occurred: {exception} - Retrying in {delay:.0f}s (Attempt {attempt + 2})"
+                    )
+                    return
+                if not ignore_errors:
+                    error = exception
+                    error_variables = variables
+                    raise exception
+                result = error_value
+            checkpoint.add(i, result)
+            pbar.update(1)
+
+        try:
+            if concurrency > 1:
+                mp_context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=concurrency, mp_context=mp_context) as pool:
+                    futures = {}
+                    try:
+                        while not scheduler.is_finished() or futures:
+                            # Keep a bounded number of runs queued so the input is only read as fast as runs finish
+                            while len(futures) < 2 * concurrency:
+                                next_run = scheduler.next_run(block=False)
+                                if next_run is None:
+                                    break
+                                i, variables, attempt = next_run
+                                futures[pool.submit(run, program_name, variables, headless)] = next_run
+                            if not futures:
+                                time.sleep(scheduler.get_wait_time())
+                                continue
+                            finished_futures, _ = wait(
+                                futures, timeout=scheduler.get_wait_time() or None, return_when=FIRST_COMPLETED
+                            )
+                            for future in finished_futures:
+                                i, variables, attempt = futures.pop(future)
+                                try:
+                                    result = future.result()
+                                except Exception as e:
+                                    finish_run(i, variables, attempt, exception=e)
+                                else:
+                                    finish_run(i, variables, attempt, result=result)
+                    finally:
+                        for future in futures:
+                            future.cancel()
+                        # The pool waits for runs that already started before shutting down, so save their results
+                        for future, (i, variables, attempt) in futures.items():
+                            if not future.cancelled() and future.exception() is None:
+                                checkpoint.add(i, future.result())
+                                pbar.update(1)
+            else:
+                while True:
+                    next_run = scheduler.next_run()
+                    if next_run is None:
+                        break
+                    i, variables, attempt = next_run
+                    try:
+                        result = run(program_name, variables, headless)
+                    except Exception as e:
+                        finish_run(i, variables, attempt, exception=e)
+                    else:
+                        finish_run(i, variables, attempt, result=result)
+        except Exception as e:
+            # Errors raised outside of a run (e.g. by a malformed input file) fail the batch as well
+            if error is None:
+                error = e
+            run_desc = f" on run with variables {error_variables}" if error_variables is not None else ""
+            logger.error(
+                f"Unresolvable error occurred{run_desc}: {error} - "
+                f"Data has been saved to {checkpoint.results_path}. Rerun your command to resume."
+            )
+        finally:
+            pbar.close()
+        if error is not None:
+            return None
+        return checkpoint.get_results(num_runs) if return_results else []
+
+
+async def _run_remote_batch(
+    pipeline_id, runs, checkpoint, pbar, max_in_flight, ignore_errors, error_value, retry_policy=None
+):
+    """
+    Starts remote runs with up to max_in_flight unfinished at once, and polls every unfinished run in one loop, saving
+    each result to the checkpoint as soon as its run finishes.  Runs the backend refused to start (e.g. because of rate
+    limiting) are started again after a backoff.
+    :return: The total number of runs in the batch.
+    """
+    import asyncio
+    from parsagon import async_api
+
+    # Runs started by an earlier attempt at the batch are waited for instead of being started again
+    in_flight = checkpoint.get_submitted()
+    in_flight_indices = set(in_flight.values())
+    num_runs = 0
+
+    def iter_pending_runs():
+        nonlocal num_runs
+        for i, variables in enumerate(runs):
+            num_runs = i + 1
+            if not checkpoint.is_done(i) and i not in in_flight_indices:
+                yield i, variables
+
+    scheduler = RunScheduler(iter_pending_runs(), retry_policy)
+    # Never poll less often than the fixed 5 second interval of single remote runs
+    poller = AdaptivePoller(initial_interval=1, max_interval=5)
+    interval = poller.initial_interval
+
+    def finish_run(i, result=None, error=None):
+        if error is not None:
+            if not ignore_errors:
+                raise ParsagonException(f"Run {i} failed: {error}")
+            result = error_value
+        checkpoint.add(i, result)
+        pbar.update(1)
+
     try:
-        for i, variables in enumerate(pbar):
-            if i < num_initial_results:
-                continue
-            for j in range(3):
-                try:
-                    results.append(run(program_name, variables, headless))
+        while True:
+            new_runs = []
+            while len(in_flight) + len(new_runs) < max_in_flight:
+                next_run = scheduler.next_run(block=False)
+                if next_run is None:
                     break
-                except Exception as e:
-                    error = e
-                    error_variables = variables
-                    if j < 2:
-                        pbar.set_description(f"An error occurred: {e} - Waiting 60s before retrying (Attempt {j+2}/3)")
-                        time.sleep(60)
-                        pbar.set_description(default_desc)
-                        error = None
-                        error_variables = None
-                        continue
+                new_runs.append(next_run)
+            if new_runs:
+                submissions = await asyncio.gather(
+                    *(async_api.create_pipeline_run(pipeline_id, variables) for _, variables, _ in new_runs),
+                    return_exceptions=True,
+                )
+                # Every started run is recorded before any failure is raised so that resuming does not start it again
+                failures = []
+                for next_run, submission in zip(new_runs, submissions):
+                    if isinstance(submission, Exception):
+                        failures.append((next_run, submission))
                     else:
-                        if ignore_errors:
-                            error = None
-                            error_variables = None
-                            results.append(error_value)
-                            break
-                        else:
-                            raise
-    except Exception as e:
-        logger.error(f"Unresolvable error occurred on run with variables {error_variables}: {error} - Data has been saved to {save_file}. Rerun your command to resume.")
+                        scheduler.record_success()
+                        in_flight[submission["id"]] = next_run[0]
+                        in_flight_indices.add(next_run[0])
+                        checkpoint.add_submitted(next_run[0], submission["id"])
+                for (i, variables, attempt), error in failures:
+                    # Runs the backend refused to start are started again after a backoff
+                    if RetryPolicy.was_rejected(error):
+                        if scheduler.record_failure(i, variables, attempt, error) is not None:
+                            continue
+                    finish_run(i, error=error)
+                interval = poller.initial_interval
+            if not in_flight:
+                if scheduler.is_finished():
+                    return num_runs
+                await asyncio.sleep(scheduler.get_wait_time())
+                continue
+
+            await asyncio.sleep(interval)
+            run_ids = list(in_flight)
+            statuses = await asyncio.gather(*(async_api.get_run(run_id) for run_id in run_ids), return_exceptions=True)
+            num_finished = 0
+            for run_id, run in zip(run_ids, statuses):
+                if isinstance(run, Exception):
+                    # A run whose status could not be fetched is polled again in the next round
+                    if RetryPolicy.classify(run) != "server":
+                        raise run
+                    continue
+                if run["status"] not in ("FINISHED", "ERROR", "CANCELED"):
+                    continue
+                i = in_flight.pop(run_id)
+                in_flight_indices.remove(i)
+                num_finished += 1
+                if run["status"] == "FINISHED":
+                    finish_run(i, result=run["output"])
+                elif run["status"] == "ERROR":
+                    finish_run(i, error=run["error"])
+                else:
+                    finish_run(i, error="Program execution was canceled")
+            if num_finished:
+                interval = poller.initial_interval
+            else:
+                interval = min(poller.max_interval, interval * poller.backoff)
     finally:
-        with open(save_file, "w") as f:
-            json.dump(results, f)
-    return None if error else results
+        await async_api.close_async_client()
+
+
+def remote_batch_runs(
+    batch_name,
+    program_name,
+    runs=[],
+    max_in_flight=50,
+    ignore_errors=False,
+    error_value=None,
+    return_results=True,
+    retry_policy=None,
+):
+    """
+    Runs a program remotely once for each set of variables in runs.  Runs are started without waiting for earlier ones
+    to finish, and each result is appended to {batch_name}.jsonl as soon as its run finishes.  Rerunning the same batch
+    skips runs that already have results and waits for runs that were already started.
+    :param runs: A list or other (possibly lazy) iterable of variable dicts, or the path to a .jsonl or .csv file with
+    one set of variables per line or row.
+    :param max_in_flight: Maximum number of runs that are started but not finished at any time.
+    :param return_results: If False, return an empty list instead of loading all results into memory once the batch
+    finishes.
+    :param retry_policy: A RetryPolicy deciding how often and after how long runs the backend refused to start (e.g.
+    because of rate limiting) are started again.
+    """
+    import asyncio
+    from tqdm import tqdm
+
+    pipeline_id = get_pipeline_cache().get_pipeline(program_name)["id"]
+    runs = iter_runs(runs)
+    # Runs read from a file are counted as they are read
+    total = len(runs) if hasattr(runs, "__len__") else None
+    with BatchCheckpoint(batch_name) as checkpoint:
+        pbar = tqdm(total=total, initial=checkpoint.num_done)
+        pbar.set_description(f'Running program "{program_name}" remotely')
+        try:
+            num_runs = asyncio.run(
+                _run_remote_batch(
+                    pipeline_id, runs, checkpoint, pbar, max_in_flight, ignore_errors, error_value, retry_policy
+                )
+            )
+        except Exception as e:
+            logger.error(
+                f"Unresolvable error occurred: {e} - Data has been saved to {checkpoint.results_path}. "
+                "Rerun your command to resume."
+            )
+            return None
+        finally:
+            pbar.close()
+        return checkpoint.get_results(num_runs) if return_results else []
 
 
 def delete(program_name, verbose=False, confirm_with_user=False):
@@ -389,9 +698,11 @@ def delete(program_name, verbose=False, confirm_with_user=False):
         logger.error("Cancelled operation.")
         return
     logger.info("Preparing to delete program %s", program_name)
-    pipeline_id = get_pipeline(program_name)["id"]
+    pipeline_cache = get_pipeline_cache()
+    pipeline_id = pipeline_cache.get_pipeline(program_name)["id"]
     logger.info("Deleting program...")
     delete_pipeline(pipeline_id)
+    pipeline_cache.invalidate(program_name)
     logger.info("Done.")
 
 
@@ -403,6 +714,7 @@ def setup(verbose=False):
     try:
         save_setting("api_key", None)
         get_api_key(interactive=True)
+        close_client()
     except KeyboardInterrupt:
         save_setting("api_key", old_api_key)
         logger.error("\nCancelled operation.")
@@ -410,16 +722,78 @@ def setup(verbose=False):
     logger.info("Setup complete.")
 
 
+def serve(host="127.0.0.1", port=8765, socket_path=None, concurrency=2, max_queue=100, headless=False, verbose=False):
+    """
+    Runs programs on request until interrupted, keeping worker processes warm between runs.  See
+    RunServer.make_http_server for the protocol.
+    """
+    get_api_key()  # Fail before starting workers if Parsagon is not set up
+    logger.info("Starting workers...")
+    run_server = RunServer(run, concurrency, max_queue, headless)
+    http_server = run_server.make_http_server(host, port, socket_path)
+    address = socket_path or f"http://{host}:{port}"
+    logger.info(f"Serving on {address} - press Ctrl+C to stop")
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        run_server.close()
+        if socket_path:
+            Path(socket_path).unlink(missing_ok=True)
+    logger.info("Stopped.")
+
+
+def _poll_data(url, page_type, timeout):
+    def check_data():
+        result = poll_data(url, page_type, wait=get_api_long_poll_wait())
+        return result["done"], result
+
+    try:
+        return AdaptivePoller(initial_interval=1, max_interval=15).poll(check_data, timeout=timeout)["result"]
+    except TimeoutError:
+        logger.info(f"No data found for {url}")
+        return None
+
+
 def _get_data(url, page_type, timeout):
-    start_time = time.time()
+    from halo import Halo
+
     with Halo(text="Extracting data...", spinner="dots"):
-        while time.time() - start_time <= timeout:
-            result = poll_data(url, page_type)
-            if result["done"]:
-                return result["result"]
-            time.sleep(15)
-    logger.info("No data found")
-    return None
+        return _poll_data(url, page_type, timeout)
+
+
+def _get_bulk_data(urls, page_type, concurrency, timeout):
+    """
+    Extracts data from many URLs at once, yielding (url, result) tuples in the order extractions finish.  The result is
+    None if no data was found for the URL within the timeout or its extraction failed.
+    """
+    urls = iter(urls)
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    futures = {}
+    try:
+        while True:
+            # Keep a bounded number of URLs queued so the input is only read as fast as extractions finish
+            for url in islice(urls, 2 * concurrency - len(futures)):
+                futures[pool.submit(_poll_data, url, page_type, timeout)] = url
+            if not futures:
+                return
+            finished_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished_futures:
+                url = futures.pop(future)
+                try:
+                    result = future.result()
+                except (ParsagonException, httpx.TransportError) as e:
+                    # One failed URL should not stop the extraction of the others
+                    message = e.to_string(False) if isinstance(e, ParsagonException) else repr(e)
+                    logger.info(f"Could not extract data from {url}: {message}")
+                    result = None
+                yield url, result
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
 
 
 def get_product(url, timeout=300):
@@ -432,3 +806,27 @@ def get_review_article(url, timeout=300):
 
 def get_article_list(url, timeout=300):
     return _get_data(url, "ARTICLE_LIST", timeout)
+
+
+def get_products(urls, concurrency=10, timeout=300):
+    """
+    Extracts product details from many URLs, polling for up to concurrency of them at once.
+    :param urls: An iterable of URLs, which is read as extractions finish.
+    :param timeout: Maximum number of seconds to wait for the data of each URL.
+    :return: A generator of (url, result) tuples in the order extractions finish.
+    """
+    return _get_bulk_data(urls, "PRODUCT_DETAIL", concurrency, timeout)
+
+
+def get_review_articles(urls, concurrency=10, timeout=300):
+    """
+    Like get_products, but for review articles.
+    """
+    return _get_bulk_data(urls, "REVIEW_ARTICLE_DETAIL", concurrency, timeout)
+
+
+def get_article_lists(urls, concurrency=10, timeout=300):
+    """
+    Like get_products, but for article lists.
+    """
+    return _get_bulk_data(urls, "ARTICLE_LIST", concurrency, timeout)
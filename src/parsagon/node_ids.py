@@ -0,0 +1,104 @@
+from itertools import islice
+
+
+# Defines encodeNodeIds(ids), which encodes node IDs as a list of [first, last] ranges of consecutive integer IDs.  IDs
+# that are not integers (such as null for an unmarked element) are kept as they are.  Order and duplicates are
+# preserved, so decoding gives back the original IDs.
+ENCODE_NODE_IDS_JS = """
+const encodeNodeIds = (ids) => {
+    const ranges = [];
+    for (const idStr of ids) {
+        const id = idStr === null ? NaN : Number(idStr);
+        if (!Number.isInteger(id) || String(id) !== idStr) {
+            ranges.push(idStr);
+            continue;
+        }
+        const last = ranges[ranges.length - 1];
+        if (Array.isArray(last) && last[1] + 1 === id) {
+            last[1] = id;
+        } else {
+            ranges.push([id, id]);
+        }
+    }
+    return ranges;
+};
+"""
+
+
+class NodeIdRanges:
+    """
+    A sequence of node IDs stored as ranges of consecutive IDs.  Since node IDs are assigned in document order, the IDs
+    of an element and its descendants mostly form a handful of ranges however large the element is.  IDs are decoded to
+    strings, as they appear in data-psgn-id attributes, when iterated over or converted to JSON.
+    """
+
+    def __init__(self, ranges, nested=False):
+        """
+        :param ranges: A list of [first, last] ranges of integer IDs and of IDs that are not integers, as returned by
+        encodeNodeIds.
+        :param nested: Whether to_json wraps each ID in a list of its own, as in the nodes of scraped fields.
+        """
+        self.ranges = ranges
+        self.nested = nested
+
+    @classmethod
+    def from_ids(cls, ids, nested=False):
+        ranges = []
+        for node_id in ids:
+            if isinstance(node_id, str) and node_id.isdigit() and str(int(node_id)) == node_id:
+                node_id = int(node_id)
+                if ranges and isinstance(ranges[-1], list) and ranges[-1][1] + 1 == node_id:
+                    ranges[-1][1] = node_id
+                else:
+                    ranges.append([node_id, node_id])
+            else:
+                ranges.append(node_id)
+        return cls(ranges, nested)
+
+    def __iter__(self):
+        for entry in self.ranges:
+            if isinstance(entry, list):
+                for node_id in range(entry[0], entry[1] + 1):
+                    yield str(node_id)
+            else:
+                yield entry
+
+    def __len__(self):
+        return sum(entry[1] - entry[0] + 1 if isinstance(entry, list) else 1 for entry in self.ranges)
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        for node_id in islice(self, index, None):
+            return node_id
+        raise IndexError("node ID index out of range")
+
+    def __eq__(self, other):
+        if isinstance(other, NodeIdRanges):
+            return self.ranges == other.ranges and self.nested == other.nested
+        return NotImplemented
+
+    def __repr__(self):
+        return f"NodeIdRanges({self.ranges!r})"
+
+    def to_json(self):
+        if self.nested:
+            return [[node_id] for node_id in self]
+        return list(self)
+
+
+def to_json_compatible(value):
+    """
+    Recursively replaces objects with a to_json method (such as NodeIdRanges and CustomFunction) in dicts and lists
+    with their JSON representation.
+    """
+    if hasattr(value, "to_json"):
+        return to_json_compatible(value.to_json())
+    if isinstance(value, dict):
+        return {key: to_json_compatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_compatible(item) for item in value]
+    return value
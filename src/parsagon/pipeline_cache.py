@@ -0,0 +1,152 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from parsagon import settings
+from parsagon.api import get_pipeline_if_changed, get_pipeline_code_if_changed
+from parsagon.exceptions import ProgramNotFoundException
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of compiled programs kept in memory
+MAX_CODE_OBJECTS = 32
+# Maximum number of backend responses kept in memory
+MAX_ENTRIES = 256
+
+_pipeline_cache = None
+_pipeline_cache_lock = threading.Lock()
+
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PipelineCache:
+    """
+    Caches pipeline metadata and generated code locally, revalidating entries with the backend via ETags so unchanged
+    programs are not re-sent, and keeps compiled code objects in memory so unchanged programs are not recompiled.
+    Generated code is only cached in memory, since there is an entry for each set of variables and the code contains
+    their values.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: Directory in which to persist pipeline metadata between processes.  If None, entries are only
+        kept in memory.
+        """
+        self.directory = Path(directory) if directory else None
+        self._entries = OrderedDict()
+        self._code_objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, pipeline_name, key):
+        # Entries are prefixed with the hash of the pipeline name so that all entries of a pipeline can be invalidated
+        return self.directory / f"{_hash(pipeline_name)}-{_hash(key)}.json"
+
+    @staticmethod
+    def _is_persisted(key):
+        return key[0] != "code"
+
+    def _cache_entry(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def _load(self, pipeline_name, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None or self.directory is None or not self._is_persisted(key):
+            return entry
+        try:
+            with self._path(pipeline_name, key).open() as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self._cache_entry(key, entry)
+        return entry
+
+    def _store(self, pipeline_name, key, entry):
+        self._cache_entry(key, entry)
+        if self.directory is None or not self._is_persisted(key):
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(pipeline_name, key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def _fetch(self, pipeline_name, key, fetch_if_changed):
+        """
+        Returns the cached response for the key if the backend reports that it is unchanged, otherwise the new response.
+        :param fetch_if_changed: A function taking an ETag (or None) and returning a tuple (response, etag).
+        """
+        entry = self._load(pipeline_name, key)
+        try:
+            response, etag = fetch_if_changed(entry["etag"] if entry else None)
+        except ProgramNotFoundException:
+            self.invalidate(pipeline_name)
+            raise
+        if response is None and entry is not None:
+            logger.debug("Using cached %s for %s", key[0], pipeline_name)
+            return entry["response"]
+        if etag:
+            self._store(pipeline_name, key, {"etag": etag, "response": response})
+        return response
+
+    def get_pipeline(self, pipeline_name):
+        key = ("pipeline", pipeline_name)
+        return self._fetch(pipeline_name, key, lambda etag: get_pipeline_if_changed(pipeline_name, etag))
+
+    def get_pipeline_code(self, pipeline_name, variables, headless):
+        key = ("code", pipeline_name, _hash(variables), headless)
+        return self._fetch(
+            pipeline_name, key, lambda etag: get_pipeline_code_if_changed(pipeline_name, variables, headless, etag)
+        )
+
+    def compile(self, pipeline_name, code):
+        """
+        Compiles pipeline code, reusing the code object from a previous call with the same code.
+        """
+        code_hash = hashlib.sha256(code.encode()).hexdigest()
+        with self._lock:
+            if code_hash in self._code_objects:
+                self._code_objects.move_to_end(code_hash)
+                return self._code_objects[code_hash]
+        code_object = compile(code, f"<program {pipeline_name}>", "exec")
+        with self._lock:
+            self._code_objects[code_hash] = code_object
+            while len(self._code_objects) > MAX_CODE_OBJECTS:
+                self._code_objects.popitem(last=False)
+        return code_object
+
+    def invalidate(self, pipeline_name):
+        """
+        Removes all cached entries for a pipeline.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == pipeline_name]:
+                del self._entries[key]
+        if self.directory is not None:
+            for path in self.directory.glob(f"{_hash(pipeline_name)}-*.json"):
+                path.unlink(missing_ok=True)
+
+
+def get_pipeline_cache():
+    """
+    Returns the shared pipeline cache, which is persisted to disk unless disabled.
+    """
+    global _pipeline_cache
+    with _pipeline_cache_lock:
+        if _pipeline_cache is None:
+            directory = settings.get_cache_dir() / "pipelines" if settings.get_pipeline_cache_enabled() else None
+            _pipeline_cache = PipelineCache(directory)
+        return _pipeline_cache
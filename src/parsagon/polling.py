@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_polling_stats = {"results": 0, "timeouts": 0, "polls": 0, "total_time_to_result": 0.0, "max_time_to_result": 0.0}
+_polling_stats_lock = threading.Lock()
+
+
+def get_polling_stats():
+    """
+    Returns the number of polls made and results received, and the total and maximum time it took to get a result.
+    """
+    with _polling_stats_lock:
+        return dict(_polling_stats)
+
+
+class AdaptivePoller:
+    """
+    Polls until a result is ready, starting with short intervals and backing off to longer ones.  Intervals are measured
+    from the start of each poll, so a server that holds a poll open until something changes (long polling) is polled
+    again right away.
+    """
+
+    def __init__(self, initial_interval=1, max_interval=10, backoff=1.5):
+        """
+        :param initial_interval: Seconds between the first two polls.
+        :param max_interval: Maximum number of seconds between polls.
+        :param backoff: Factor by which the interval grows after each poll.
+        """
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+    def poll(self, check, timeout=None):
+        """
+        Calls check until it reports that the result is ready.
+        :param check: A function returning a tuple (done, result).
+        :param timeout: Maximum number of seconds to poll for, or None to poll until done.
+        :return: The result.
+        :raises TimeoutError: If the result is not ready before the timeout.
+        """
+        start_time = time.monotonic()
+        interval = self.initial_interval
+        num_polls = 0
+        while True:
+            poll_start_time = time.monotonic()
+            done, result = check()
+            num_polls += 1
+            now = time.monotonic()
+            if done:
+                self._record(num_polls, now - start_time)
+                logger.debug("Got result after %.1fs and %s polls", now - start_time, num_polls)
+                return result
+            if timeout is not None and now - start_time >= timeout:
+                self._record(num_polls, None)
+                raise TimeoutError(f"No result after {timeout}s")
+            sleep_time = interval - (now - poll_start_time)
+            if timeout is not None:
+                sleep_time = min(sleep_time, start_time + timeout - now)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            interval = min(self.max_interval, interval * self.backoff)
+
+    @staticmethod
+    def _record(num_polls, time_to_result):
+        with _polling_stats_lock:
+            _polling_stats["polls"] += num_polls
+            if time_to_result is None:
+                _polling_stats["timeouts"] += 1
+                return
+            _polling_stats["results"] += 1
+            _polling_stats["total_time_to_result"] += time_to_result
+            _polling_stats["max_time_to_result"] = max(_polling_stats["max_time_to_result"], time_to_result)
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from parsagon import settings
+
+logger = logging.getLogger(__name__)
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    """
+    An on-disk cache of API responses keyed by a hash of the request.  Entries expire after a TTL, and the least
+    recently used entries are evicted once the cache grows beyond a maximum size.
+    """
+
+    def __init__(self, directory, ttl, max_size):
+        """
+        :param directory: Directory in which to store cached responses.
+        :param ttl: Number of seconds after which an entry expires.
+        :param max_size: Maximum total size of the cache in bytes.
+        """
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(method, endpoint, payload):
+        # The cache directory is shared by every backend (e.g. staging and production), so the key includes the base URL
+        request = json.dumps([settings.get_api_base(), method, endpoint, payload], sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """
+        :return: A tuple (hit, response).
+        """
+        path = self._path(key)
+        try:
+            with path.open() as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._count(False)
+            return False, None
+        if time.time() - entry["created"] > self.ttl:
+            path.unlink(missing_ok=True)
+            self._count(False)
+            return False, None
+        # Access times are unreliable on many filesystems, so the modification time tracks recency of use
+        os.utime(path)
+        self._count(True)
+        return True, entry["response"]
+
+    def set(self, key, response):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump({"created": time.time(), "response": response}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            logger.debug("Evicted cached response %s", path.name)
+
+    def clear(self):
+        for path in self.directory.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def get_response_cache():
+    """
+    Returns the shared response cache, or None if response caching is disabled.
+    """
+    global _response_cache
+    if not settings.get_response_cache_enabled():
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                settings.get_cache_dir() / "responses",
+                settings.get_response_cache_ttl(),
+                settings.get_response_cache_max_size(),
+            )
+        return _response_cache
@@ -4,10 +4,28 @@ import sys
 from os import environ
 from pathlib import Path
 
+import httpx
+
 from parsagon.exceptions import ParsagonException
 
 __API_BASE = environ.get("API_BASE", "https://parsagon.io").rstrip("/")
 __SETTINGS_FILE = environ.get("SETTINGS_FILE", ".parsagon_profile")
+__API_CONNECT_TIMEOUT = float(environ.get("API_CONNECT_TIMEOUT", 10))
+__API_READ_TIMEOUT = float(environ.get("API_READ_TIMEOUT", 600))
+__API_MAX_CONNECTIONS = int(environ.get("API_MAX_CONNECTIONS", 100))
+__API_HTTP2 = environ.get("API_HTTP2", "").lower() in ("1", "true", "yes")
+__API_MAX_RETRIES = int(environ.get("API_MAX_RETRIES", 4))
+__API_MAX_RETRY_DELAY = float(environ.get("API_MAX_RETRY_DELAY", 8))
+__API_RETRY_DEADLINE = float(environ.get("API_RETRY_DEADLINE", 60))
+__API_HEDGE_DELAY = environ.get("API_HEDGE_DELAY")
+__API_LONG_POLL_WAIT = float(environ.get("API_LONG_POLL_WAIT", 0))
+__API_COMPRESSION = environ.get("API_COMPRESSION", "").lower()
+__API_COMPRESSION_MIN_SIZE = int(environ.get("API_COMPRESSION_MIN_SIZE", 32768))
+__CACHE_DIR = environ.get("CACHE_DIR", ".parsagon_cache")
+__RESPONSE_CACHE = environ.get("RESPONSE_CACHE", "1").lower() not in ("0", "false", "no")
+__RESPONSE_CACHE_TTL = float(environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 60 * 60))
+__RESPONSE_CACHE_MAX_SIZE = int(environ.get("RESPONSE_CACHE_MAX_SIZE", 200 * 1024 * 1024))
+__PIPELINE_CACHE = environ.get("PIPELINE_CACHE", "1").lower() not in ("0", "false", "no")
 
 
 logger = logging.getLogger(__name__)
@@ -86,6 +104,94 @@ def get_api_base():
         return __API_BASE
 
 
+def get_api_timeout():
+    """
+    Return timeouts for API calls.  Reads may take a long time since some endpoints run language models.
+    """
+    return httpx.Timeout(__API_READ_TIMEOUT, connect=__API_CONNECT_TIMEOUT)
+
+
+def get_api_max_connections():
+    return __API_MAX_CONNECTIONS
+
+
+def get_api_http2():
+    return __API_HTTP2
+
+
+def get_api_max_retries():
+    return __API_MAX_RETRIES
+
+
+def get_api_max_retry_delay():
+    return __API_MAX_RETRY_DELAY
+
+
+def get_api_retry_deadline():
+    """
+    Return the number of seconds after the first attempt of an API call after which it is no longer retried
+    """
+    return __API_RETRY_DEADLINE
+
+
+def get_api_hedge_delay():
+    """
+    Return the number of seconds after which a slow read-only API call is duplicated, or None if hedging is disabled
+    """
+    return float(__API_HEDGE_DELAY) if __API_HEDGE_DELAY else None
+
+
+def get_api_long_poll_wait():
+    """
+    Return the number of seconds the server may hold a status poll open until the status changes, or None to poll
+    without waiting
+    """
+    return __API_LONG_POLL_WAIT or None
+
+
+def get_api_compression():
+    """
+    Return the encoding ("gzip" or "zstd") used to compress large request bodies, or None if compression is disabled
+    """
+    if __API_COMPRESSION in ("gzip", "zstd"):
+        return __API_COMPRESSION
+    return None
+
+
+def get_api_compression_min_size():
+    return __API_COMPRESSION_MIN_SIZE
+
+
+def get_cache_dir():
+    """
+    Return the directory for local caches, which is a hidden directory in the user's home directory unless an absolute
+    path is configured
+    """
+    return Path().home() / __CACHE_DIR
+
+
+def get_response_cache_enabled():
+    """
+    Return whether API responses may be cached locally, preventing tests from sharing a cache
+    """
+    return __RESPONSE_CACHE and not pytest_is_running()
+
+
+def get_response_cache_ttl():
+    return __RESPONSE_CACHE_TTL
+
+
+def get_response_cache_max_size():
+    return __RESPONSE_CACHE_MAX_SIZE
+
+
+def get_pipeline_cache_enabled():
+    """
+    Return whether pipelines may be cached on disk, preventing tests from sharing a cache
+    """
+    return __PIPELINE_CACHE and not pytest_is_running()
+
+
 def get_logging_config(log_level="INFO"):
     return {
         "version": 1,
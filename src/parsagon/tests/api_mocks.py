@@ -1,4 +1,3 @@
-import functools
 import json
 import re
 
@@ -6,8 +5,9 @@ from httpx import codes
 
 
 class MockResponse:
-    def __init__(self, status_code, json_body=None, text_body=None):
+    def __init__(self, status_code, json_body=None, text_body=None, headers=None):
         self.status_code = status_code
+        self.headers = headers or {}
         self.json_body = json_body
         self.text_body = text_body
         assert not (json_body and text_body)
@@ -33,7 +33,7 @@ not_found_response = MockResponse(404, json_body={"detail": "Not found."})
 
 def mock_httpx_method_func(*args, **kwargs):
     """
-    A mock that is used for httpx post, get, put, patch, and delete methods.  The "method" kwarg differentiates which mock is being called, and the "mock_options" kwarg provides further options pertaining to the desired behavior of the mock. The following keys are supported:
+    A mock that is used for requests made through the shared httpx client.  The "method" kwarg differentiates which mock is being called, and the "mock_options" kwarg provides further options pertaining to the desired behavior of the mock. The following keys are supported:
 
     - code_to_return: For operations that require code to be returned, this will be used.
     """
@@ -76,6 +76,18 @@ def mock_httpx_method_func(*args, **kwargs):
     raise Exception("Unknown combination of method and url: %s %s" % (method, url))
 
 
+class MockClient:
+    """
+    Stands in for the shared httpx client, dispatching every request to mock_httpx_method_func.
+    """
+
+    def __init__(self, mock_options):
+        self.mock_options = mock_options
+
+    def request(self, method, url, **kwargs):
+        return mock_httpx_method_func(url, method=method, mock_options=self.mock_options, **kwargs)
+
+
 def install_api_mocks(mocker, mock_options=None):
     """
     Installs mocks for the backend. The "mock_options" kwarg can be used to customize responses. See mock_httpx_method_func for details.
@@ -84,9 +96,5 @@ def install_api_mocks(mocker, mock_options=None):
     if mock_options is None:
         mock_options = {}
 
-    # NOTE: Remember to update this if we add code that introduces other calling points to the backend, or if we change the way these httpx method functions are imported.
-    for method in ["get", "post", "put", "patch", "delete"]:
-        mocker.patch(
-            "parsagon.api.httpx.%s" % method,
-            functools.partial(mock_httpx_method_func, method=method, mock_options=mock_options),
-        )
+    # NOTE: Remember to update this if we add code that introduces other calling points to the backend, or if we change the way the shared client is obtained.
+    mocker.patch("parsagon.api.get_client", lambda: MockClient(mock_options))
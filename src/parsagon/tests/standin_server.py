@@ -0,0 +1,116 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class StandInServer:
+    """
+    A local stand-in for the Parsagon backend that serves remote runs and data extraction, finishing each job a fixed
+    number of seconds after it is created.  A run outputs the "output" variable it was started with, and fails if it was
+    started with a "fail" variable.  Status requests with a "wait" query parameter are held open until the job
+    finishes or the wait elapses, like a backend that supports long polling.
+    """
+
+    def __init__(self, job_duration, long_polling=True):
+        self.job_duration = job_duration
+        self.long_polling = long_polling
+        self.num_status_requests = 0
+        self.job_start_times = {}
+        self.run_variables = {}
+        self.max_unfinished_runs = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    def _start_job(self, key):
+        with self._lock:
+            return self.job_start_times.setdefault(key, time.monotonic())
+
+    def _create_run(self, variables):
+        with self._lock:
+            now = time.monotonic()
+            num_unfinished_runs = sum(
+                1
+                for key, start_time in self.job_start_times.items()
+                if key[0] == "run" and start_time + self.job_duration > now
+            )
+            self.max_unfinished_runs = max(self.max_unfinished_runs, num_unfinished_runs + 1)
+            run_id = str(len(self.run_variables) + 1)
+            self.run_variables[run_id] = variables
+            self.job_start_times[("run", run_id)] = now
+        return run_id
+
+    def _wait_for_job(self, key, wait):
+        with self._lock:
+            self.num_status_requests += 1
+        finish_time = self._start_job(key) + self.job_duration
+        if self.long_polling and wait:
+            time.sleep(max(0, min(finish_time, time.monotonic() + wait) - time.monotonic()))
+        return time.monotonic() >= finish_time
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, body):
+                content = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _read_json(self):
+                return json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                wait = float(parse_qs(url.query).get("wait", [0])[0])
+                if match := re.fullmatch(r"/api/pipelines/runs/(\d+)/", url.path):
+                    run_id = match.group(1)
+                    done = server._wait_for_job(("run", run_id), wait)
+                    variables = server.run_variables.get(run_id, {})
+                    if not done:
+                        status = "RUNNING"
+                    else:
+                        status = "ERROR" if variables.get("fail") else "FINISHED"
+                    output = variables.get("output", "output")
+                    self._respond({"id": int(run_id), "status": status, "output": output, "error": "Run failed"})
+                elif match := re.fullmatch(r"/api/pipelines/name/(.+)/", url.path):
+                    self._respond({"id": 1, "name": match.group(1)})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                wait = float(parse_qs(url.query).get("wait", [0])[0])
+                if re.fullmatch(r"/api/pipelines/(\d+)/runs/", url.path):
+                    run_id = server._create_run(self._read_json()["variables"])
+                    self._respond({"id": int(run_id)})
+                elif url.path == "/api/extract/":
+                    url = self._read_json()["url"]
+                    done = server._wait_for_job(("extract", url), wait)
+                    self._respond({"done": done, "result": {"url": url} if done else None})
+                else:
+                    self.send_error(404)
+
+        return Handler
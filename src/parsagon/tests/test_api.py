@@ -0,0 +1,135 @@
+import asyncio
+import gzip
+import json
+import threading
+
+import httpx
+import pytest
+
+from parsagon import api, async_api
+from parsagon.exceptions import APIException, ProgramNotFoundException
+
+
+def test_client_is_shared_until_closed():
+    client = api.get_client()
+    assert api.get_client() is client
+    assert str(client.base_url) == "http://test/api/"
+    assert client.headers["Authorization"] == "Token test"
+    api.close_client()
+    assert client.is_closed
+    assert api.get_client() is not client
+    api.close_client()
+
+
+def test_async_api_raises_same_exceptions(mocker):
+    def handler(request):
+        if request.url.path == "/api/pipelines/name/missing/":
+            return httpx.Response(404, json={"detail": "Not found."})
+        if request.url.path == "/api/pipelines/runs/1/":
+            return httpx.Response(502)
+        return httpx.Response(200, json={"id": 1, "name": "found"})
+
+    mocker.patch("parsagon.settings.get_api_max_retries", lambda: 0)
+    mocker.patch(
+        "parsagon.async_api._create_client",
+        lambda client_class: client_class(base_url="http://test/api", transport=httpx.MockTransport(handler)),
+    )
+
+    async def call_api():
+        assert (await async_api.get_pipeline("found"))["id"] == 1
+        with pytest.raises(ProgramNotFoundException):
+            await async_api.get_pipeline("missing")
+        with pytest.raises(APIException, match="Lost connection"):
+            await async_api.get_run(1)
+        await async_api.close_async_client()
+
+    asyncio.run(call_api())
+
+
+def test_large_html_bodies_are_compressed(mocker):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"data": [], "nodes": {}})
+
+    mocker.patch(
+        "parsagon.api.get_client",
+        lambda: httpx.Client(base_url="http://test/api", transport=httpx.MockTransport(handler)),
+    )
+    mocker.patch("parsagon.settings.get_api_compression", lambda: "gzip")
+    mocker.patch("parsagon.settings.get_api_compression_min_size", lambda: 1000)
+    stats_before = api.get_upload_stats()
+
+    html = "<html>" + "<p>text</p>" * 1000 + "</html>"
+    api.scrape_page(html, {"title": "str"}, [])
+    api.scrape_page("<html></html>", {"title": "str"}, [])
+
+    assert requests[0].headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(requests[0].content))["html"] == html
+    assert "Content-Encoding" not in requests[1].headers
+    stats = api.get_upload_stats()
+    assert stats["requests"] - stats_before["requests"] == 2
+    assert stats["compressed_requests"] - stats_before["compressed_requests"] == 1
+    assert stats["sent_bytes"] - stats_before["sent_bytes"] < stats["raw_bytes"] - stats_before["raw_bytes"]
+
+
+def test_transient_failures_are_retried_only_when_safe(mocker):
+    statuses = []
+
+    def handler(request):
+        statuses.append(502 if len(statuses) % 2 == 0 else 200)
+        return httpx.Response(statuses[-1], json={"id": 1, "status": "RUNNING"})
+
+    mocker.patch(
+        "parsagon.api.get_client",
+        lambda: httpx.Client(base_url="http://test/api", transport=httpx.MockTransport(handler)),
+    )
+    mocker.patch("parsagon.api.time.sleep")
+
+    assert api.get_run(1)["status"] == "RUNNING"
+    assert statuses == [502, 200]
+
+    # Creating a run is not idempotent, so a 502 (which the server may have processed) is not retried
+    with pytest.raises(APIException, match="Lost connection"):
+        api.create_pipeline_run(1, {})
+    assert statuses == [502, 200, 502]
+
+
+def test_rate_limited_requests_are_retried_after_the_requested_delay(mocker):
+    statuses = []
+
+    def handler(request):
+        statuses.append(429 if len(statuses) % 2 == 0 else 200)
+        return httpx.Response(statuses[-1], json={"id": 1}, headers={"Retry-After": "3"})
+
+    mocker.patch(
+        "parsagon.api.get_client",
+        lambda: httpx.Client(base_url="http://test/api", transport=httpx.MockTransport(handler)),
+    )
+    sleep = mocker.patch("parsagon.api.time.sleep")
+
+    # Rate limited requests were not processed, so even creating a run is retried
+    assert api.create_pipeline_run(1, {})["id"] == 1
+    assert statuses == [429, 200]
+    sleep.assert_called_once_with(3.0)
+
+
+def test_slow_read_only_requests_are_hedged(mocker):
+    first_request_sent = threading.Event()
+    release_first_request = threading.Event()
+
+    def handler(request):
+        if not first_request_sent.is_set():
+            first_request_sent.set()
+            release_first_request.wait(5)
+            return httpx.Response(200, json={"status": "SLOW"})
+        return httpx.Response(200, json={"status": "FAST"})
+
+    client = httpx.Client(base_url="http://test/api", transport=httpx.MockTransport(handler))
+    mocker.patch("parsagon.api.get_client", lambda: client)
+    mocker.patch("parsagon.settings.get_api_hedge_delay", lambda: 0.05)
+    try:
+        assert api.get_run(1)["status"] == "FAST"
+    finally:
+        release_first_request.set()
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+
+import pytest
+
+from parsagon import batch_runs
+from parsagon.batch import BatchCheckpoint, CircuitBreaker, RetryPolicy
+from parsagon.exceptions import APIException, ProgramNotFoundException
+
+
+class MockProcessPoolExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers, mp_context=None):
+        super().__init__(max_workers=max_workers)
+
+
+no_backoff = RetryPolicy(base_delay=0)
+
+
+def mock_run(program_name, variables, headless):
+    # time.sleep is mocked out to skip retry waits
+    threading.Event().wait(variables["delay"])
+    if variables.get("fail"):
+        raise Exception("Run failed")
+    return variables["delay"]
+
+
+def test_parallel_results_are_saved_in_input_order(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.ProcessPoolExecutor", MockProcessPoolExecutor)
+    mocker.patch("parsagon.main.run", mock_run)
+    mocker.patch("parsagon.main.time.sleep")
+    runs = [{"delay": 0.3}, {"delay": 0.1, "fail": True}, {"delay": 0.2}, {"delay": 0}]
+
+    results = batch_runs(
+        "batch", "program", runs, ignore_errors=True, error_value="error", concurrency=4, retry_policy=no_backoff
+    )
+
+    assert results == [0.3, "error", 0.2, 0]
+    assert BatchCheckpoint("batch").get_results(len(runs)) == results
+
+
+def test_legacy_results_are_imported(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.ProcessPoolExecutor", MockProcessPoolExecutor)
+    run = mocker.patch("parsagon.main.run", return_value="new")
+    with open("batch.json", "w") as f:
+        json.dump(["old"], f)
+
+    assert batch_runs("batch", "program", [{}, {}], concurrency=2) == ["old", "new"]
+    assert run.call_count == 1
+
+
+def test_results_are_checkpointed_as_runs_finish(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.time.sleep")
+    mocker.patch("parsagon.main.run", side_effect=["first"] + [Exception("Run failed")] * 3)
+
+    assert batch_runs("batch", "program", [{}, {}], retry_policy=no_backoff) is None
+    with BatchCheckpoint("batch") as checkpoint:
+        assert checkpoint.is_done(0) and not checkpoint.is_done(1)
+
+    # A partially written line from a killed process is discarded on resume
+    with open("batch.jsonl", "a") as f:
+        f.write('{"index": 1, "res')
+    run = mocker.patch("parsagon.main.run", return_value="second")
+    assert batch_runs("batch", "program", [{}, {}]) == ["first", "second"]
+    assert run.call_count == 1
+
+
+def test_runs_are_streamed_from_files(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.ProcessPoolExecutor", MockProcessPoolExecutor)
+    mocker.patch("parsagon.main.run", lambda program_name, variables, headless: variables["query"])
+    with open("runs.csv", "w") as f:
+        f.write("query\nfirst\nsecond\nthird\n")
+    with open("runs.jsonl", "w") as f:
+        f.write('{"query": "first"}\n{"query": "second"}\n')
+
+    tqdm = mocker.patch("tqdm.tqdm", wraps=__import__("tqdm").tqdm)
+    assert batch_runs("csv_batch", "program", "runs.csv", concurrency=2) == ["first", "second", "third"]
+    # The length of a file path is not the number of runs in the file
+    assert tqdm.call_args.kwargs["total"] is None
+    assert batch_runs("jsonl_batch", "program", "runs.jsonl") == ["first", "second"]
+    assert batch_runs("iter_batch", "program", ({"query": str(i)} for i in range(3))) == ["0", "1", "2"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_errors_reading_runs_fail_the_batch(mocker, tmp_path, monkeypatch, concurrency):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.ProcessPoolExecutor", MockProcessPoolExecutor)
+    mocker.patch("parsagon.main.run", lambda program_name, variables, headless: variables["query"])
+    with open("runs.jsonl", "w") as f:
+        f.write('{"query": 1}\n{"query": 2}\n{"query": \n{"query": 4}\n')
+
+    assert batch_runs("batch", "program", "runs.jsonl", concurrency=concurrency) is None
+
+
+def test_failed_runs_are_requeued_behind_other_runs(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def flaky_run(program_name, variables, headless):
+        calls.append(variables["id"])
+        if variables["id"] == 0 and calls.count(0) == 1:
+            raise APIException("Lost connection to server.", 502)
+        return variables["id"]
+
+    mocker.patch("parsagon.main.run", flaky_run)
+    runs = [{"id": i} for i in range(3)]
+    assert batch_runs("batch", "program", runs, retry_policy=RetryPolicy(base_delay=0.2)) == [0, 1, 2]
+    assert calls == [0, 1, 2, 0]
+
+
+def test_unrecoverable_errors_are_not_retried(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run = mocker.patch("parsagon.main.run", side_effect=ProgramNotFoundException("program"))
+    assert batch_runs("batch", "program", [{}], ignore_errors=True, error_value="error") == ["error"]
+    assert run.call_count == 1
+
+
+def test_rate_limited_runs_are_retried_after_the_requested_delay():
+    retry_policy = RetryPolicy(base_delay=0)
+    assert RetryPolicy.classify(APIException("Too many requests.", 429)) == "server"
+    assert retry_policy.get_retry_delay(APIException("Too many requests.", 429, retry_after=30), 0) == 30
+
+
+def test_started_runs_are_saved_after_a_fatal_error(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("parsagon.main.ProcessPoolExecutor", MockProcessPoolExecutor)
+
+    def run(program_name, variables, headless):
+        if variables.get("missing"):
+            raise ProgramNotFoundException(program_name)
+        threading.Event().wait(0.2)
+        return "done"
+
+    mocker.patch("parsagon.main.run", run)
+    assert batch_runs("batch", "program", [{}, {"missing": True}], concurrency=2) is None
+    with BatchCheckpoint("batch") as checkpoint:
+        assert checkpoint.is_done(0) and not checkpoint.is_done(1)
+
+
+def test_circuit_breaker_pauses_after_server_errors():
+    circuit_breaker = CircuitBreaker(failure_threshold=2, cooldown=10)
+    circuit_breaker.record_failure("browser")
+    circuit_breaker.record_failure("server")
+    assert circuit_breaker.get_wait_time() == 0
+    circuit_breaker.record_failure("server")
+    assert 9 < circuit_breaker.get_wait_time() <= 10
@@ -0,0 +1,22 @@
+import json
+
+from parsagon.browser import get_driver_path
+
+
+def test_driver_path_is_resolved_once(mocker, tmp_path):
+    mocker.patch("parsagon.browser.settings.get_cache_dir", return_value=tmp_path)
+    driver_path = tmp_path / "chromedriver"
+    driver_path.touch()
+    install = mocker.patch("parsagon.browser.ChromeDriverManager").return_value.install
+    install.return_value = str(driver_path)
+
+    assert get_driver_path() == str(driver_path)
+    assert get_driver_path() == str(driver_path)
+    assert install.call_count == 1
+    with open(tmp_path / "chromedriver.json") as f:
+        assert json.load(f) == {"path": str(driver_path)}
+
+    # A driver that was deleted since is resolved again
+    driver_path.unlink()
+    get_driver_path()
+    assert install.call_count == 2
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import urllib.error
+import urllib.request
+
+from parsagon.daemon import RunServer
+from parsagon.exceptions import ParsagonException
+
+
+class MockProcessPoolExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        super().__init__(max_workers=max_workers)
+
+
+def post_run(http_server, body, content_type="application/json"):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{http_server.server_address[1]}/run",
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": content_type},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def serve(mocker, run, **kwargs):
+    mocker.patch("parsagon.daemon.ProcessPoolExecutor", MockProcessPoolExecutor)
+    run_server = RunServer(run, **kwargs)
+    http_server = run_server.make_http_server(port=0)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return run_server, http_server
+
+
+def test_runs_are_served(mocker):
+    def run(program_name, variables, headless, remote):
+        if variables.get("fail"):
+            raise ParsagonException("Run failed")
+        return {"program": program_name, "variables": variables, "headless": headless}
+
+    run_server, http_server = serve(mocker, run, headless=True)
+    try:
+        assert post_run(http_server, {"program_name": "program", "variables": {"a": 1}}) == (
+            200,
+            {"output": {"program": "program", "variables": {"a": 1}, "headless": True}},
+        )
+        assert post_run(http_server, {"program_name": "program", "variables": {"fail": True}}) == (
+            500,
+            {"error": "Run failed"},
+        )
+        assert post_run(http_server, {"variables": {}})[0] == 400
+        # Requests that web pages can send without a CORS preflight are refused
+        assert post_run(http_server, {"program_name": "program"}, "text/plain")[0] == 415
+        assert run_server.stats() == {"running": 0, "queued": 0, "finished": 2}
+    finally:
+        http_server.shutdown()
+        run_server.close()
+
+
+def test_runs_are_rejected_when_the_queue_is_full(mocker):
+    started = threading.Event()
+    release = threading.Event()
+
+    def run(program_name, variables, headless, remote):
+        started.set()
+        release.wait()
+        return "done"
+
+    run_server, http_server = serve(mocker, run, concurrency=1, max_queue=0)
+    try:
+        results = []
+        thread = threading.Thread(target=lambda: results.append(post_run(http_server, {"program_name": "program"})))
+        thread.start()
+        started.wait()
+        assert run_server.stats()["running"] == 1
+        assert post_run(http_server, {"program_name": "program"})[0] == 503
+        release.set()
+        thread.join()
+        assert results == [(200, {"output": "done"})]
+    finally:
+        http_server.shutdown()
+        run_server.close()
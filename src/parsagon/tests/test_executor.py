@@ -1,20 +1,139 @@
-from parsagon.executor import Executor
+import pytest
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+from parsagon.executor import (
+    Executor,
+    DOM_VERSION_SCRIPT,
+    ELEM_BY_ID_SCRIPT,
+    INVISIBLE_ELEM_IDS_SCRIPT,
+    SELECTED_NODE_IDS_SCRIPT,
+)
 
 
 class MockDriver:
-    def __init__(self, current_url, page_source):
+    def __init__(self, current_url, page_source, script_results=None):
         self.current_url = current_url
-        self.page_source = page_source
+        self.current_window_handle = "window"
+        self.script_results = script_results or {}
+        self.executed_scripts = []
+        self.page_source_reads = 0
+        self.round_trips = 0
+        self.cdp_commands = []
+        self.cdp_error = None
+        self._page_source = page_source
+
+    @property
+    def page_source(self):
+        self.page_source_reads += 1
+        return self._page_source
+
+    def execute_script(self, script, *args):
+        self.round_trips += 1
+        self.executed_scripts.append(script)
+        result = self.script_results.get(script)
+        return result(*args) if callable(result) else result
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        if self.cdp_error is not None:
+            raise self.cdp_error
+        self.cdp_commands.append(cmd)
+        return {"identifier": str(len(self.cdp_commands))}
 
 
 class MockExecutor(Executor):
-    def __init__(self, current_url, page_source):
-        self.driver = MockDriver(current_url, page_source)
+    def __init__(self, current_url, page_source, script_results=None, infer=False):
+        self.driver = MockDriver(current_url, page_source, script_results)
         self.max_elem_id = 0
         self.custom_functions = {}
+        self.cleaned_page_cache = {}
+        self.highlights_windows = {}
+        self.highlights_script = "highlights"
+        self.infer = infer
 
 
 def test_makes_links_absolute():
     executor = MockExecutor("https://example.com/", '<html><body><a href="/stuff">Stuff</a></body></html>')
     root = executor._get_cleaned_lxml_root()
     assert root[0][0].get("href") == "https://example.com/stuff"
+
+
+def test_visible_html_removes_invisible_elements():
+    executor = MockExecutor(
+        "https://example.com/",
+        '<html data-psgn-id="0"><body data-psgn-id="1"><div data-psgn-id="2"><span data-psgn-id="3">Hidden</span></div>'
+        '<p data-psgn-id="4">Shown</p></body></html>',
+        script_results={INVISIBLE_ELEM_IDS_SCRIPT: ["2"]},
+    )
+    html = executor.get_visible_html()
+    assert "Hidden" not in html
+    assert "Shown" in html
+    assert executor.driver.executed_scripts.count(INVISIBLE_ELEM_IDS_SCRIPT) == 1
+
+
+def test_cleaned_page_is_cached_until_dom_changes():
+    executor = MockExecutor(
+        "https://example.com/",
+        '<html data-psgn-id="0"><head data-psgn-id="1"><title data-psgn-id="2">Title</title></head>'
+        '<body data-psgn-id="3"><p data-psgn-id="4">Text</p></body></html>',
+        script_results={DOM_VERSION_SCRIPT: "abc:1:https://example.com/", INVISIBLE_ELEM_IDS_SCRIPT: ["1"]},
+    )
+    html = executor.get_scrape_html()
+    assert "Title" not in executor.get_visible_html()
+    assert executor.get_scrape_html() == html
+    assert executor.driver.page_source_reads == 1
+
+    executor.driver.script_results[DOM_VERSION_SCRIPT] = "abc:2:https://example.com/"
+    executor.get_scrape_html()
+    assert executor.driver.page_source_reads == 2
+
+
+def test_elements_are_looked_up_by_id_in_the_page_registry():
+    elems = {"1": "elem"}
+    executor = MockExecutor(
+        "https://example.com/", "<html></html>", script_results={ELEM_BY_ID_SCRIPT: lambda elem_id: elems.get(elem_id)}
+    )
+    assert executor._id_to_elem(1) == "elem"
+    with pytest.raises(NoSuchElementException):
+        executor._id_to_elem(2)
+
+
+@pytest.mark.parametrize("num_matches", [1, 100, 2000])
+def test_selected_node_ids_take_one_round_trip(num_matches):
+    elem_ids = [str(i) for i in range(num_matches)]
+    executor = MockExecutor(
+        "https://example.com/",
+        "<html></html>",
+        script_results={SELECTED_NODE_IDS_SCRIPT: lambda css, xpath: [[0, num_matches - 1]]},
+    )
+    for selector in ({"css_selector": ".card"}, {"xpath_selector": "//div"}, {}):
+        executor.driver.round_trips = 0
+        assert list(executor.get_selected_node_ids(**selector)) == elem_ids
+        assert executor.driver.round_trips == 1
+
+
+def test_highlights_script_is_registered_once_per_window():
+    executor = MockExecutor("https://example.com/", "<html></html>")
+    for _ in range(3):
+        executor.inject_highlights_script()
+    assert executor.driver.executed_scripts.count("highlights") == 1
+    assert executor.driver.cdp_commands == ["Page.addScriptToEvaluateOnNewDocument"]
+
+    executor.driver.current_window_handle = "other window"
+    executor.inject_highlights_script()
+    assert executor.driver.executed_scripts.count("highlights") == 2
+
+
+def test_highlights_script_is_reinjected_without_cdp():
+    executor = MockExecutor("https://example.com/", "<html></html>")
+    executor.driver.cdp_error = WebDriverException("CDP is not supported")
+    for _ in range(3):
+        executor.inject_highlights_script()
+    assert executor.driver.executed_scripts.count("highlights") == 3
+
+
+def test_highlights_script_is_only_injected_for_selections_in_infer_mode():
+    executor = MockExecutor("https://example.com/", "<html></html>", infer=True)
+    executor.inject_highlights_script()
+    assert "highlights" not in executor.driver.executed_scripts
+    executor.highlights_setup("ACTION")
+    assert executor.driver.executed_scripts.count("highlights") == 1
@@ -0,0 +1,54 @@
+import json
+import subprocess
+import sys
+
+# Modules that only commands driving a browser or showing progress need
+HEAVY_MODULES = [
+    "selenium",
+    "undetected_chromedriver",
+    "webdriver_manager",
+    "pyvirtualdisplay",
+    "lxml",
+    "halo",
+    "tqdm",
+    "psutil",
+]
+
+# Seconds that importing parsagon may take on top of httpx, which every command needs to call the API
+IMPORT_TIME_BUDGET = 0.25
+
+
+def get_import_times():
+    """
+    Imports parsagon in a fresh interpreter and returns the cumulative import time in seconds of each module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import parsagon"], capture_output=True, text=True, check=True
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        import_times[name.strip()] = int(cumulative) / 1e6
+    return import_times
+
+
+def test_heavy_modules_are_not_imported():
+    result = subprocess.run(
+        [sys.executable, "-c", "import json, sys, parsagon; print(json.dumps(list(sys.modules)))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported_modules = {name.split(".")[0] for name in json.loads(result.stdout)}
+    assert imported_modules.isdisjoint(HEAVY_MODULES)
+
+
+def test_import_time_is_within_budget():
+    # Take the fastest of a few imports to ignore noise from other processes
+    import_time = min(
+        import_times["parsagon"] - import_times.get("httpx", 0)
+        for import_times in (get_import_times() for _ in range(3))
+    )
+    assert import_time < IMPORT_TIME_BUDGET
@@ -0,0 +1,29 @@
+from parsagon.custom_function import CustomFunction
+from parsagon.node_ids import NodeIdRanges, to_json_compatible
+
+
+def test_node_ids_are_encoded_as_ranges():
+    ids = ["1", "2", "3", None, "5", "7", "8", "007", "4"]
+    node_ids = NodeIdRanges.from_ids(ids)
+    assert node_ids.ranges == [[1, 3], None, [5, 5], [7, 8], "007", [4, 4]]
+    assert list(node_ids) == ids
+    assert len(node_ids) == len(ids)
+    assert node_ids[3] is None and node_ids[-1] == "4"
+
+
+def test_large_subtrees_stay_compact():
+    node_ids = NodeIdRanges([[10, 200009]])
+    assert len(node_ids) == 200000
+    assert node_ids[0] == "10"
+
+
+def test_node_ids_are_expanded_in_payloads():
+    nodes = {"title": NodeIdRanges([[1, 2]], nested=True)}
+    custom_function = CustomFunction("scrape_data", {}, [{"nodes": nodes}])
+    payload = {"relevant_elem_ids": NodeIdRanges([[1, 2], None]), **custom_function.to_json()}
+    assert to_json_compatible(payload) == {
+        "relevant_elem_ids": ["1", "2", None],
+        "name": "scrape_data",
+        "arguments": {},
+        "examples_data": [{"nodes": {"title": [["1"], ["2"]]}}],
+    }
@@ -0,0 +1,62 @@
+from parsagon.pipeline_cache import PipelineCache
+from parsagon.tests.api_mocks import MockResponse
+
+
+def test_unchanged_code_is_revalidated_and_compiled_once(mocker, tmp_path):
+    requests = []
+
+    class MockClient:
+        def request(self, method, url, headers=None, **kwargs):
+            requests.append(headers)
+            if headers.get("If-None-Match") == '"v1"':
+                return MockResponse(304)
+            return MockResponse(200, json_body={"code": "output = 1"}, headers={"ETag": '"v1"'})
+
+    mocker.patch("parsagon.api.get_client", MockClient)
+    pipeline_cache = PipelineCache(tmp_path)
+    code = pipeline_cache.get_pipeline_code("my_program", {"a": 1}, False)["code"]
+    assert pipeline_cache.get_pipeline_code("my_program", {"a": 1}, False)["code"] == code
+    assert requests == [{}, {"If-None-Match": '"v1"'}]
+    assert pipeline_cache.compile("my_program", code) is pipeline_cache.compile("my_program", code)
+
+    # Code contains the values of the variables, so it is not written to disk
+    assert not list(tmp_path.iterdir())
+    assert PipelineCache(tmp_path).get_pipeline_code("my_program", {"a": 1}, False)["code"] == code
+    assert requests[-1] == {}
+
+    pipeline_cache.invalidate("my_program")
+    assert pipeline_cache.get_pipeline_code("my_program", {"a": 1}, False)["code"] == code
+    assert requests[-1] == {}
+
+
+def test_pipelines_persist_to_disk(mocker, tmp_path):
+    requests = []
+
+    class MockClient:
+        def request(self, method, url, headers=None, **kwargs):
+            requests.append(headers)
+            if headers.get("If-None-Match") == '"v1"':
+                return MockResponse(304)
+            return MockResponse(200, json_body={"id": 1}, headers={"ETag": '"v1"'})
+
+    mocker.patch("parsagon.api.get_client", MockClient)
+    assert PipelineCache(tmp_path).get_pipeline("my_program") == {"id": 1}
+    # A new process revalidates the entry saved by the first one
+    pipeline_cache = PipelineCache(tmp_path)
+    assert pipeline_cache.get_pipeline("my_program") == {"id": 1}
+    assert requests == [{}, {"If-None-Match": '"v1"'}]
+
+    pipeline_cache.invalidate("my_program")
+    assert not list(tmp_path.iterdir())
+
+
+def test_entries_are_evicted(mocker):
+    mocker.patch("parsagon.pipeline_cache.MAX_ENTRIES", 2)
+    mocker.patch(
+        "parsagon.pipeline_cache.get_pipeline_code_if_changed",
+        lambda pipeline_name, variables, headless, etag: ({"code": f"output = {variables['a']}"}, '"v1"'),
+    )
+    pipeline_cache = PipelineCache()
+    for i in range(5):
+        pipeline_cache.get_pipeline_code("my_program", {"a": i}, False)
+    assert len(pipeline_cache._entries) == 2
@@ -0,0 +1,143 @@
+import time
+
+import httpx
+
+from parsagon import get_product, get_products, remote_batch_runs, run
+from parsagon import async_api
+from parsagon.batch import BatchCheckpoint, RetryPolicy
+from parsagon.exceptions import APIException
+from parsagon.polling import get_polling_stats
+from parsagon.tests.standin_server import StandInServer
+
+
+def use_server(mocker, server, long_poll_wait=None):
+    client = httpx.Client(base_url=server.base_url)
+    mocker.patch("parsagon.api.get_client", lambda: client)
+    mocker.patch("parsagon.async_api._create_client", lambda client_class: client_class(base_url=server.base_url))
+    mocker.patch("parsagon.main.get_api_long_poll_wait", lambda: long_poll_wait)
+
+
+def test_remote_run_backs_off_while_polling(mocker):
+    with StandInServer(job_duration=1.5, long_polling=False) as server:
+        use_server(mocker, server)
+        stats_before = get_polling_stats()
+        assert run("program", remote=True) == "output"
+        # Polls at 0, 1, and 2.5 seconds instead of every second
+        assert server.num_status_requests <= 3
+        stats = get_polling_stats()
+        assert stats["results"] - stats_before["results"] == 1
+        assert stats["max_time_to_result"] >= 1.5
+
+
+def test_long_polling_returns_as_soon_as_data_is_ready(mocker):
+    with StandInServer(job_duration=0.5) as server:
+        use_server(mocker, server, long_poll_wait=20)
+        assert get_product("https://example.com/product") == {"url": "https://example.com/product"}
+        assert server.num_status_requests == 1
+
+
+def test_extraction_times_out(mocker):
+    with StandInServer(job_duration=10) as server:
+        use_server(mocker, server)
+        assert get_product("https://example.com/product", timeout=0.2) is None
+
+
+def test_remote_batch_keeps_a_bounded_number_of_runs_in_flight(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with StandInServer(job_duration=0.2) as server:
+        use_server(mocker, server)
+        runs = [{"output": i} for i in range(6)]
+        assert remote_batch_runs("batch", "program", runs, max_in_flight=3) == list(range(6))
+        assert server.max_unfinished_runs == 3
+        # Every run is polled in the same round, so three rounds cover six runs
+        assert server.num_status_requests == 6
+
+
+def test_remote_batch_saves_failed_runs(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with StandInServer(job_duration=0) as server:
+        use_server(mocker, server)
+        runs = [{"output": "a"}, {"fail": True}]
+        assert remote_batch_runs("batch", "program", runs) is None
+        assert remote_batch_runs("batch", "program", runs, ignore_errors=True, error_value="error") == ["a", "error"]
+        with BatchCheckpoint("batch") as checkpoint:
+            assert checkpoint.get_submitted() == {}
+
+
+def reject_first_submission(mocker, status_code):
+    create_pipeline_run = async_api.create_pipeline_run
+    rejected = []
+
+    async def mock_create_pipeline_run(pipeline_id, variables):
+        if variables["output"] == 0 and not rejected:
+            rejected.append(variables)
+            raise APIException("Too many requests.", status_code)
+        return await create_pipeline_run(pipeline_id, variables)
+
+    mocker.patch("parsagon.async_api.create_pipeline_run", mock_create_pipeline_run)
+
+
+def test_remote_batch_records_started_runs_before_failing(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with StandInServer(job_duration=10) as server:
+        use_server(mocker, server)
+        reject_first_submission(mocker, 400)
+        runs = [{"output": i} for i in range(3)]
+        assert remote_batch_runs("batch", "program", runs) is None
+        # The runs that were started alongside the failed one are waited for on resume instead of being started again
+        with BatchCheckpoint("batch") as checkpoint:
+            assert sorted(checkpoint.get_submitted().values()) == [1, 2]
+
+
+def test_remote_batch_restarts_rate_limited_runs(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with StandInServer(job_duration=0) as server:
+        use_server(mocker, server)
+        reject_first_submission(mocker, 429)
+        runs = [{"output": i} for i in range(3)]
+        results = remote_batch_runs(
+            "batch", "program", runs, ignore_errors=True, error_value="error", retry_policy=RetryPolicy(base_delay=0)
+        )
+        assert results == [0, 1, 2]
+        assert len(server.run_variables) == 3
+
+
+def test_bulk_extraction_polls_urls_concurrently(mocker):
+    with StandInServer(job_duration=0.5) as server:
+        use_server(mocker, server, long_poll_wait=20)
+        urls = [f"https://example.com/product/{i}" for i in range(8)]
+        start_time = time.monotonic()
+        results = dict(get_products(urls, concurrency=8))
+        assert time.monotonic() - start_time < 2
+        assert results == {url: {"url": url} for url in urls}
+
+
+def test_bulk_extraction_times_out_per_url(mocker):
+    with StandInServer(job_duration=10) as server:
+        use_server(mocker, server)
+        urls = ["https://example.com/product/1", "https://example.com/product/2"]
+        assert dict(get_products(urls, timeout=0.2)) == {url: None for url in urls}
+
+
+def test_bulk_extraction_continues_after_failed_url(mocker):
+    def mock_poll_data(url, page_type, wait=None):
+        if url.endswith("/1"):
+            raise APIException("Not found", 404)
+        return {"done": True, "result": {"url": url}}
+
+    mocker.patch("parsagon.main.poll_data", mock_poll_data)
+    urls = [f"https://example.com/product/{i}" for i in range(3)]
+    results = dict(get_products(urls))
+    assert results == {urls[0]: {"url": urls[0]}, urls[1]: None, urls[2]: {"url": urls[2]}}
+
+
+def test_bulk_extraction_continues_after_network_error(mocker):
+    def mock_poll_data(url, page_type, wait=None):
+        if url.endswith("/1"):
+            raise httpx.ReadTimeout("Timed out")
+        return {"done": True, "result": {"url": url}}
+
+    mocker.patch("parsagon.main.poll_data", mock_poll_data)
+    urls = [f"https://example.com/product/{i}" for i in range(3)]
+    results = dict(get_products(urls))
+    assert results == {urls[0]: {"url": urls[0]}, urls[1]: None, urls[2]: {"url": urls[2]}}
@@ -0,0 +1,47 @@
+import httpx
+
+from parsagon import api
+from parsagon.response_cache import ResponseCache
+
+
+def test_identical_requests_are_served_from_cache(mocker, tmp_path):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"title": "str"})
+
+    response_cache = ResponseCache(tmp_path, ttl=60, max_size=1024 * 1024)
+    mocker.patch("parsagon.api.get_response_cache", lambda: response_cache)
+    mocker.patch(
+        "parsagon.api.get_client",
+        lambda: httpx.Client(base_url="http://test/api", transport=httpx.MockTransport(handler)),
+    )
+
+    assert api.get_schema_fields({"title": "str"}) == {"title": "str"}
+    assert api.get_schema_fields({"title": "str"}) == {"title": "str"}
+    assert len(requests) == 1
+    assert response_cache.stats() == {"hits": 1, "misses": 1}
+
+    api.get_schema_fields({"name": "str"})
+    assert len(requests) == 2
+
+    # Responses from one backend are not served for another
+    mocker.patch("parsagon.settings.get_api_base", lambda: "http://staging")
+    api.get_schema_fields({"title": "str"})
+    assert len(requests) == 3
+
+
+def test_expired_entries_are_misses(tmp_path):
+    response_cache = ResponseCache(tmp_path, ttl=-1, max_size=1024 * 1024)
+    response_cache.set("key", {"data": 1})
+    assert response_cache.get("key") == (False, None)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    response_cache = ResponseCache(tmp_path, ttl=60, max_size=150)
+    for key in ("a", "b", "c"):
+        response_cache.set(key, "x" * 20)
+        (tmp_path / f"{key}.json").touch()
+    assert response_cache.get("a")[0] is False
+    assert response_cache.get("c") == (True, "x" * 20)
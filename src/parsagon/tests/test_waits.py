@@ -0,0 +1,43 @@
+from selenium.common.exceptions import JavascriptException
+
+from parsagon import waits
+from parsagon.waits import PageSettler
+
+
+class MockDriver:
+    def __init__(self, states):
+        self.states = states
+        self.calls = 0
+
+    def execute_script(self, script, *args):
+        self.calls += 1
+        state = self.states[min(self.calls, len(self.states)) - 1]
+        if isinstance(state, Exception):
+            raise state
+        return state
+
+
+def page_state(ready_state="complete", inflight=0, quiet_ms=1000):
+    return {"readyState": ready_state, "inflight": inflight, "unloading": False, "quietMs": quiet_ms}
+
+
+def test_waits_until_requests_finish(mocker):
+    mocker.patch.object(waits, "POLL_INTERVAL", 0)
+    mocker.patch.object(waits, "QUIET_PERIOD", 0)
+    driver = MockDriver([page_state("loading"), page_state(inflight=3), page_state(inflight=2)])
+    assert PageSettler(driver).wait("click")
+    assert driver.calls == 3
+
+
+def test_gives_up_on_pages_that_never_settle(mocker):
+    mocker.patch.object(waits, "POLL_INTERVAL", 0)
+    mocker.patch.dict(waits.SETTLE_TIMEOUTS, {"click": 0.05})
+    driver = MockDriver([page_state(inflight=5)])
+    assert not PageSettler(driver).wait("click")
+
+
+def test_falls_back_to_fixed_sleep(mocker):
+    sleep = mocker.patch("parsagon.waits.time.sleep")
+    driver = MockDriver([JavascriptException("document unloaded")])
+    assert not PageSettler(driver).wait("goto")
+    assert sleep.call_args[0][0] > 0
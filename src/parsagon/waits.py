@@ -0,0 +1,155 @@
+import logging
+import time
+
+from selenium.common.exceptions import StaleElementReferenceException, WebDriverException
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of seconds to wait for the page to settle after each kind of action.  Pages with streaming requests
+# or constantly changing content (tickers, carousels) never settle, so these stay close to the fixed sleeps.
+SETTLE_TIMEOUTS = {
+    "goto": 3,
+    "click": 3,
+    "next_page": 2,
+    "select": 3,
+    "fill": 3,
+    "scroll": 2,
+    "press_key": 2,
+}
+
+# Fixed number of seconds to sleep after each kind of action when page state cannot be read
+FALLBACK_SLEEPS = {
+    "goto": 2,
+    "click": 2,
+    "next_page": 1,
+    "select": 2,
+    "fill": 2,
+    "scroll": 1,
+    "press_key": 1,
+}
+
+# Maximum number of seconds to wait for an element to become displayed and enabled before interacting with it
+ELEM_READY_TIMEOUT = 2
+
+# The page is considered settled once it is nearly idle: at most MAX_IDLE_REQUESTS requests younger than
+# LONG_REQUEST_AGE seconds are in flight (older ones are assumed to be long polls or streams) and the DOM has not
+# changed for QUIET_PERIOD seconds
+QUIET_PERIOD = 0.25
+MAX_IDLE_REQUESTS = 2
+LONG_REQUEST_AGE = 5
+POLL_INTERVAL = 0.05
+
+
+# Installs (once per document) counters for in-flight fetch/XHR requests and DOM mutations, then reports page state
+SETTLE_STATE_SCRIPT = """
+if (!window.psgnSettleState) {
+    const state = { requests: new Set(), unloading: false, lastActivity: performance.now() };
+    window.psgnSettleState = state;
+    const touch = () => { state.lastActivity = performance.now(); };
+    const start = () => {
+        const request = { startTime: performance.now() };
+        state.requests.add(request);
+        touch();
+        return () => { state.requests.delete(request); touch(); };
+    };
+    const origFetch = window.fetch;
+    if (origFetch) {
+        window.fetch = function (...args) {
+            const finish = start();
+            return origFetch.apply(this, args).finally(finish);
+        };
+    }
+    const origSend = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function (...args) {
+        this.addEventListener('loadend', start(), { once: true });
+        return origSend.apply(this, args);
+    };
+    new MutationObserver(touch).observe(document, { childList: true, subtree: true, characterData: true });
+    window.addEventListener('beforeunload', () => { state.unloading = true; });
+}
+const state = window.psgnSettleState;
+const now = performance.now();
+let inflight = 0;
+for (const request of state.requests) {
+    if (now - request.startTime < arguments[0] * 1000) {
+        inflight++;
+    }
+}
+return {
+    readyState: document.readyState,
+    inflight,
+    unloading: state.unloading,
+    quietMs: performance.now() - state.lastActivity,
+};
+"""
+
+
+class PageSettler:
+    """
+    Waits for the page to settle after an action by watching document readiness, in-flight network requests, and DOM
+    mutations instead of sleeping for a fixed amount of time.
+    """
+
+    def __init__(self, driver, adaptive=True):
+        """
+        :param driver: The selenium driver of the page to watch.
+        :param adaptive: If False, always sleep for the fixed fallback duration of each action.
+        """
+        self.driver = driver
+        self.adaptive = adaptive
+
+    def _is_settled(self, state):
+        return (
+            state["readyState"] == "complete"
+            and not state["unloading"]
+            and state["inflight"] <= MAX_IDLE_REQUESTS
+            and state["quietMs"] >= QUIET_PERIOD * 1000
+        )
+
+    def wait(self, action):
+        """
+        Blocks until the page has settled after the given action or the action's timeout elapses.
+        :param action: A key of SETTLE_TIMEOUTS.
+        :return: True if the page settled, False otherwise.
+        """
+        fallback = FALLBACK_SLEEPS[action]
+        if not self.adaptive:
+            time.sleep(fallback)
+            return True
+
+        start = time.monotonic()
+        timeout = SETTLE_TIMEOUTS[action]
+        while True:
+            elapsed = time.monotonic() - start
+            try:
+                state = self.driver.execute_script(SETTLE_STATE_SCRIPT, LONG_REQUEST_AGE)
+            except WebDriverException as e:
+                logger.debug("Could not read page state (%s) - falling back to a fixed wait", e.__class__.__name__)
+                time.sleep(max(0, fallback - elapsed))
+                return False
+            if elapsed >= QUIET_PERIOD and self._is_settled(state):
+                logger.debug("Page settled after %.2fs", elapsed)
+                return True
+            if elapsed >= timeout:
+                logger.debug("Page did not settle within %ss", timeout)
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def wait_for_elem(self, elem, timeout):
+        """
+        Blocks until the element is displayed and enabled or the timeout elapses.
+        :return: True if the element is ready for interaction, False otherwise.
+        """
+        start = time.monotonic()
+        while True:
+            try:
+                if elem.is_displayed() and elem.is_enabled():
+                    return True
+            except StaleElementReferenceException:
+                return False
+            except WebDriverException:
+                pass
+            if time.monotonic() - start >= timeout:
+                return False
+            time.sleep(POLL_INTERVAL)